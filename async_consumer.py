@@ -0,0 +1,141 @@
+import time
+from typing import AsyncIterable, Iterable, List, Optional, Union
+
+import redis.asyncio
+
+import main
+import retention
+import streams
+from codec import Codec, anegotiate, encode_fields, t_codec
+from consumer import DEFAULT_MAX_BATCH, DEFAULT_MAX_LINGER_MS
+from interface import AsyncConsumer, t_consumer_id
+from metrics import BATCH_SIZE, ROUND_TRIP, MetricsSink
+from sharding import ShardRouter
+
+
+class AsyncStreamConsumer(AsyncConsumer):
+    """asyncio counterpart of `consumer.StreamConsumer`.
+
+  Uses the shared, bounded pool of `main.async_redis_server` unless a client
+  or a router is given.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.asyncio.Redis] = None,
+                 max_batch: int = DEFAULT_MAX_BATCH,
+                 max_linger_ms: int = DEFAULT_MAX_LINGER_MS,
+                 codec: t_codec = None,
+                 retention: Optional[retention.RetentionPolicy] = None,
+                 inline_trim: bool = True,
+                 router: Optional[ShardRouter] = None,
+                 metrics: Optional[MetricsSink] = None):
+        self.client = client or main.async_redis_server()
+        self.router = main.default_router(client, router)
+        self.max_batch = max_batch
+        self.max_linger_ms = max_linger_ms
+        self.preferred_codec = codec
+        self.codec: Optional[Codec] = None
+        self.retention = retention
+        self.inline_trim = inline_trim and retention is not None
+        self.metrics = metrics
+        self.channel: Optional[str] = None
+
+    async def setup(self,
+                    channel: Optional[str] = None,
+                    **kwargs) -> t_consumer_id:
+        """Setup the consumer on `channel`, or on a freshly named one."""
+        self.channel = channel or streams.new_channel()
+        if self.router is not None:
+            self.client = self.router.async_client_for(self.channel)
+        self.codec = await anegotiate(self.client, self.channel,
+                                      self.preferred_codec)
+        if self.retention is not None:
+            await retention.arecord(self.client, self.channel,
+                                    self.retention)
+        return self.channel
+
+    async def consume(self, data: dict, **optional_attrs) -> bytes:
+        """Append one event to the channel and return its stream id."""
+        if self.inline_trim:
+            optional_attrs = {
+                **self.retention.xadd_kwargs(),
+                **optional_attrs
+            }
+        channel = self._channel()
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        message_id = await self.client.xadd(channel,
+                                            encode_fields(self.codec, data),
+                                            **optional_attrs)
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=channel,
+                                 command="xadd")
+        return message_id
+
+    async def consume_many(self,
+                           events: Union[Iterable[dict], AsyncIterable[dict]],
+                           max_batch: Optional[int] = None,
+                           max_linger_ms: Optional[int] = None,
+                           **optional_attrs) -> List[bytes]:
+        """Append events in pipelined batches and return their stream ids.
+
+    Accepts plain and async iterables. The buffer is flushed once it holds
+    `max_batch` events, or once its oldest event has waited `max_linger_ms`
+    as checked when the next event arrives; unlike
+    `consumer.StreamConsumer.consume_many`, there is no timed flush while
+    `events` waits.
+    """
+        max_batch = max_batch or self.max_batch
+        if max_linger_ms is None:
+            max_linger_ms = self.max_linger_ms
+        linger = max_linger_ms / 1000.0
+        channel = self._channel()
+        ids: List[bytes] = []
+        buffer: List[dict] = []
+        deadline = 0.0
+        async for data in _aiter(events):
+            if not buffer:
+                deadline = time.monotonic() + linger
+            buffer.append(data)
+            if len(buffer) >= max_batch or time.monotonic() >= deadline:
+                ids.extend(await self._flush(channel, buffer, optional_attrs))
+                buffer = []
+        if buffer:
+            ids.extend(await self._flush(channel, buffer, optional_attrs))
+        return ids
+
+    async def _flush(self, channel: str, buffer: List[dict],
+                     optional_attrs: dict) -> List[bytes]:
+        if self.inline_trim:
+            optional_attrs = {
+                **self.retention.xadd_kwargs(),
+                **optional_attrs
+            }
+        async with self.client.pipeline(transaction=False) as pipe:
+            for data in buffer:
+                pipe.xadd(channel, encode_fields(self.codec, data),
+                          **optional_attrs)
+            start = time.perf_counter() if self.metrics is not None else 0.0
+            ids = await pipe.execute()
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=channel,
+                                 command="pipeline")
+            self.metrics.observe(BATCH_SIZE, len(buffer), channel=channel)
+        return ids
+
+    def _channel(self) -> str:
+        if self.channel is None:
+            raise RuntimeError("Consumer.setup() must be called first.")
+        return self.channel
+
+
+async def _aiter(events):
+    if hasattr(events, "__aiter__"):
+        async for data in events:
+            yield data
+    else:
+        for data in events:
+            yield data
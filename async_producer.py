@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+import redis.asyncio
+
+import main
+import streams
+from codec import Codec, alookup, decode_fields, get_codec
+from interface import AsyncProducer, Message, t_consumer_id
+from metrics import (BATCH_SIZE, PENDING, PENDING_INTERVAL, ROUND_TRIP,
+                     MetricsSink, observe_delivery)
+from sharding import ShardRouter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNT = 100
+DEFAULT_BLOCK_MS = 1000
+DEFAULT_READERS = 4
+MAX_BACKOFF = 5.0
+
+
+class AsyncStreamMultiplexer:
+    """Reads many channels of one consumer group with a few blocking reads.
+
+  Channels are spread over `readers` tasks. Each task issues one
+  XREADGROUP BLOCK covering all of its channels, so thousands of channels
+  cost `readers` pooled connections rather than a connection (or thread)
+  each. A task only runs while it has channels. A channel whose local
+  queue already holds `count` undelivered messages is left out of the next
+  read until its producer catches up. A channel registered while its
+  reader is blocked is picked up once that read returns, i.e. within
+  `block_ms`. Failed reads are logged and retried with exponential backoff;
+  channels whose stream or consumer group is gone, e.g. after a
+  `sharding.rebalance`, are unregistered. Entries that cannot be decoded
+  are logged and acknowledged, after being copied to the `dead_letter`
+  stream if one is given.
+
+  Registering a channel again returns the same queue: its producers compete
+  for its messages, like the consumers of one group. The channel is read
+  until each registration has been matched by an `unregister`.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.asyncio.Redis] = None,
+                 group: str = streams.DEFAULT_GROUP,
+                 consumer: Optional[str] = None,
+                 count: int = DEFAULT_COUNT,
+                 block_ms: int = DEFAULT_BLOCK_MS,
+                 readers: int = DEFAULT_READERS,
+                 idle_interval: float = 0.01,
+                 dead_letter: Optional[str] = None,
+                 metrics: Optional[MetricsSink] = None):
+        self.client = client or main.async_redis_server()
+        self.metrics = metrics
+        self.group = group
+        self.consumer = consumer or streams.consumer_name()
+        self.count = count
+        self.block_ms = block_ms
+        self.idle_interval = idle_interval
+        self.dead_letter = dead_letter
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._registrations: Dict[str, int] = {}
+        self._codecs: Dict[str, Optional[Codec]] = {}
+        self._assignments: List[List[str]] = [[] for _ in range(readers)]
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._pending_reported: Dict[str, float] = {}
+
+    async def register(self, channel: str) -> asyncio.Queue:
+        """Creates the consumer group if needed and starts reading it."""
+        if channel in self._queues:
+            self._registrations[channel] += 1
+            return self._queues[channel]
+        try:
+            await self.client.xgroup_create(channel,
+                                            self.group,
+                                            id="0",
+                                            mkstream=True)
+        except redis.ResponseError as exc:
+            if not streams.is_busygroup(exc):
+                raise
+        codec = await alookup(self.client, channel)
+        if channel in self._queues:
+            # Registered concurrently while this call was waiting on redis.
+            self._registrations[channel] += 1
+            return self._queues[channel]
+        self._codecs[channel] = codec
+        queue: asyncio.Queue = asyncio.Queue()
+        self._queues[channel] = queue
+        self._registrations[channel] = 1
+        index = min(range(len(self._assignments)),
+                    key=lambda i: len(self._assignments[i]))
+        self._assignments[index].append(channel)
+        task = self._tasks.get(index)
+        if task is None or task.done():
+            self._tasks[index] = asyncio.ensure_future(self._read(index))
+        return queue
+
+    def unregister(self, channel: str) -> None:
+        """Stops reading `channel` once its last registration is undone."""
+        registrations = self._registrations.get(channel, 0)
+        if registrations > 1:
+            self._registrations[channel] = registrations - 1
+            return
+        self._remove(channel)
+
+    async def pending(self, channel: str) -> int:
+        """Returns the size of the group's pending entries list of `channel`.
+
+    The size is also reported to the metrics sink, if any.
+    """
+        depth = (await self.client.xpending(channel, self.group))["pending"]
+        if self.metrics is not None:
+            self.metrics.set_gauge(PENDING,
+                                   depth,
+                                   channel=channel,
+                                   group=self.group)
+        return depth
+
+    async def report_pending(self, channel: str) -> None:
+        """Reports `pending(channel)` at most every `PENDING_INTERVAL`."""
+        if self.metrics is None:
+            return
+        now = time.monotonic()
+        if now - self._pending_reported.get(channel, 0.0) < PENDING_INTERVAL:
+            return
+        self._pending_reported[channel] = now
+        try:
+            await self.pending(channel)
+        except redis.RedisError:
+            logger.exception("Reporting the pending entries of %s failed.",
+                             channel)
+
+    async def close(self) -> None:
+        """Cancels the readers."""
+        tasks = list(self._tasks.values())
+        self._tasks = {}
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Stream reader failed.", exc_info=result)
+
+    async def _read(self, index: int) -> None:
+        assigned = self._assignments[index]
+        failures = 0
+        while assigned:
+            ready = {
+                channel: ">"
+                for channel in assigned
+                if self._queues[channel].qsize() < self.count
+            }
+            if not ready:
+                await asyncio.sleep(self.idle_interval)
+                continue
+            try:
+                response = await self.client.xreadgroup(self.group,
+                                                        self.consumer,
+                                                        ready,
+                                                        count=self.count,
+                                                        block=self.block_ms)
+            except redis.RedisError as exc:
+                if (isinstance(exc, redis.ResponseError) and
+                        streams.is_nogroup(exc)):
+                    await self._drop_missing(ready)
+                    continue
+                failures += 1
+                logger.exception("Reading %d channel(s) failed.", len(ready))
+                await asyncio.sleep(self._backoff(failures))
+                continue
+            failures = 0
+            for stream, entries in response or ():
+                channel = streams.channel_name(stream)
+                try:
+                    await self._deliver(channel, entries)
+                except Exception:
+                    logger.exception("Delivering %d entries of %s failed.",
+                                     len(entries), channel)
+
+    async def _deliver(self, channel: str, entries: list) -> None:
+        queue = self._queues.get(channel)
+        if queue is None:
+            return
+        codec = self._codecs[channel]
+        if codec is None:
+            # No consumer was set up before the channel was registered; one
+            # has been by the time entries arrive.
+            codec = await alookup(self.client, channel) or get_codec()
+            if channel in self._codecs:
+                self._codecs[channel] = codec
+        undecodable = []
+        for message_id, fields in entries:
+            try:
+                data = decode_fields(codec, fields)
+            except Exception:
+                logger.exception("Discarding %s of %s: it cannot be decoded.",
+                                 streams.text(message_id), channel)
+                undecodable.append((message_id, fields))
+                continue
+            queue.put_nowait(Message(channel, message_id, data))
+        if undecodable:
+            await self._discard(channel, undecodable)
+        if self.metrics is not None and entries:
+            self.metrics.observe(BATCH_SIZE, len(entries), channel=channel)
+            observe_delivery(self.metrics, channel,
+                             (message_id for message_id, _ in entries))
+            await self.report_pending(channel)
+
+    async def _discard(self, channel: str, entries: list) -> None:
+        """Acknowledges `entries` after copying them to `dead_letter`."""
+        async with self.client.pipeline(transaction=False) as pipe:
+            if self.dead_letter is not None:
+                for _, fields in entries:
+                    pipe.xadd(self.dead_letter, fields)
+            pipe.xack(channel, self.group,
+                      *(message_id for message_id, _ in entries))
+            await pipe.execute()
+
+    async def _drop_missing(self, channels) -> None:
+        """Unregisters those of `channels` whose stream or group is gone."""
+        for channel in channels:
+            try:
+                groups = await self.client.xinfo_groups(channel)
+            except redis.ResponseError:
+                groups = []
+            except redis.RedisError:
+                logger.exception("Checking the consumer groups of %s failed.",
+                                 channel)
+                continue
+            if not any(
+                    streams.text(group["name"]) == self.group
+                    for group in groups):
+                logger.warning("Stopped reading %s: its stream or consumer "
+                               "group %s is gone.", channel, self.group)
+                self._remove(channel)
+
+    def _remove(self, channel: str) -> None:
+        self._queues.pop(channel, None)
+        self._registrations.pop(channel, None)
+        self._codecs.pop(channel, None)
+        self._pending_reported.pop(channel, None)
+        for assigned in self._assignments:
+            if channel in assigned:
+                assigned.remove(channel)
+
+    def _backoff(self, failures: int) -> float:
+        return min(self.idle_interval * 2**failures, MAX_BACKOFF)
+
+
+_multiplexers: Dict[tuple, AsyncStreamMultiplexer] = {}
+
+
+def stream_multiplexer(client: Optional[redis.asyncio.Redis] = None,
+                       group: str = streams.DEFAULT_GROUP,
+                       metrics: Optional[MetricsSink] = None,
+                       dead_letter: Optional[str] = None
+                       ) -> AsyncStreamMultiplexer:
+    """Returns the process wide multiplexer of `client`'s pool and `group`."""
+    client = client or main.async_redis_server()
+    key = (id(client.connection_pool), group, id(metrics), dead_letter)
+    if key not in _multiplexers:
+        _multiplexers[key] = AsyncStreamMultiplexer(client=client,
+                                                    group=group,
+                                                    dead_letter=dead_letter,
+                                                    metrics=metrics)
+    return _multiplexers[key]
+
+
+class AsyncStreamProducer(AsyncProducer):
+    """asyncio counterpart of a consumer group backed Streams producer.
+
+  Producers sharing a `multiplexer` share its blocking reads. Without one,
+  producers go through the process wide `stream_multiplexer()` of the node
+  their channel is routed to. Producers of one channel on one multiplexer
+  compete for its messages; each message goes to one of them.
+  """
+
+    def __init__(self,
+                 multiplexer: Optional[AsyncStreamMultiplexer] = None,
+                 client: Optional[redis.asyncio.Redis] = None,
+                 group: str = streams.DEFAULT_GROUP,
+                 auto_ack: bool = True,
+                 dead_letter: Optional[str] = None,
+                 router: Optional[ShardRouter] = None,
+                 metrics: Optional[MetricsSink] = None):
+        self.metrics = multiplexer.metrics if multiplexer else metrics
+        self.dead_letter = (multiplexer.dead_letter
+                            if multiplexer else dead_letter)
+        self.multiplexer = multiplexer
+        self.client = multiplexer.client if multiplexer else client
+        self.group = multiplexer.group if multiplexer else group
+        self.router = None if multiplexer else main.default_router(
+            client, router)
+        self.auto_ack = auto_ack
+        self.channel: Optional[str] = None
+        self._queue: Optional[asyncio.Queue] = None
+
+    async def setup(self, consumer_id: t_consumer_id, **kwargs) -> None:
+        """Setup the producer on the channel of `consumer_id`."""
+        self.channel = consumer_id
+        if self.multiplexer is None:
+            if self.router is not None:
+                self.client = self.router.async_client_for(consumer_id)
+            self.multiplexer = stream_multiplexer(self.client, self.group,
+                                                  self.metrics,
+                                                  self.dead_letter)
+            self.client = self.multiplexer.client
+        self._queue = await self.multiplexer.register(consumer_id)
+
+    async def get(self, **optional_attrs) -> AsyncIterator[Message]:
+        """Yields messages as they arrive.
+
+    With `auto_ack`, a message is acknowledged once the caller asks for the
+    next one. Acknowledgements are sent as one XACK per delivered batch, and
+    every `count` messages of the multiplexer while a backlog is queued.
+    """
+        if self._queue is None:
+            raise RuntimeError("Producer.setup() must be called first.")
+        queue = self._queue
+        count = self.multiplexer.count
+        processed: List[bytes] = []
+        try:
+            while True:
+                if processed and (queue.empty() or
+                                  len(processed) >= count):
+                    await self.ack(*processed)
+                    processed = []
+                message = await queue.get()
+                yield message
+                if self.auto_ack:
+                    processed.append(message.id)
+        finally:
+            if processed:
+                await self.ack(*processed)
+
+    async def ack(self, *message_ids) -> int:
+        """Acknowledges `message_ids` in one XACK."""
+        if not message_ids:
+            return 0
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        acked = await self.client.xack(self.channel, self.group, *message_ids)
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=self.channel,
+                                 command="xack")
+            await self.multiplexer.report_pending(self.channel)
+        return acked
+
+    async def pending(self) -> int:
+        """Returns the size of the group's pending entries list.
+
+    The size is also reported to the metrics sink, if any. With a sink, the
+    multiplexer reports it at most every `metrics.PENDING_INTERVAL` seconds
+    as messages are delivered and acknowledged.
+    """
+        if self.multiplexer is None or self.channel is None:
+            raise RuntimeError("Producer.setup() must be called first.")
+        return await self.multiplexer.pending(self.channel)
+
+    async def close(self) -> None:
+        """Stops reading the channel, unless other producers still read it."""
+        if self.multiplexer is not None and self._queue is not None:
+            self.multiplexer.unregister(self.channel)
+            self._queue = None
@@ -0,0 +1,71 @@
+"""Runs the delivery benchmark matrix and writes the results as JSON.
+
+From the repository root, either against a freshly spawned redis-server:
+
+    python -m benchmarks --output results.json
+
+or against a running one:
+
+    python -m benchmarks --url redis://localhost:6379 --output results.json
+"""
+import argparse
+import contextlib
+import sys
+
+import redis
+
+from benchmarks import harness, server
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description=__doc__.splitlines()[0])
+    parser.add_argument("--url",
+                        help="Benchmark this redis instead of spawning one.")
+    parser.add_argument("--redis-server",
+                        default="redis-server",
+                        help="redis-server executable to spawn.")
+    parser.add_argument("--modes",
+                        nargs="+",
+                        choices=harness.MODES,
+                        default=list(harness.MODES))
+    parser.add_argument("--payload-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[128, 1024])
+    parser.add_argument("--batch-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1, 100])
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--consumers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    if args.url:
+        target = contextlib.nullcontext(redis.Redis.from_url(args.url))
+    elif server.available(args.redis_server):
+        target = server.spawn(args.redis_server)
+    else:
+        print(f"{args.redis_server} not found; pass --url.", file=sys.stderr)
+        return 1
+    scenarios = harness.matrix(args.modes, args.payload_sizes,
+                               args.batch_sizes, args.channels,
+                               args.consumers, args.messages)
+    with target as client:
+        report = harness.run_all(client, scenarios)
+    harness.write(report, args.output)
+    for result in report["results"]:
+        print(f"{result['mode']:<8} payload={result['payload_size']:<6} "
+              f"batch={result['batch_size']:<5} "
+              f"channels={result['channels']:<3} "
+              f"consumers={result['consumers']:<3} "
+              f"{result['msgs_per_s']:10.0f} msgs/s "
+              f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms")
+    print(f"Wrote {args.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
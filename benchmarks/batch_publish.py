@@ -0,0 +1,61 @@
+"""Compares single XADD and pipelined batch publishing throughput.
+
+Run against a local redis-server from the repository root:
+
+    python -m benchmarks.batch_publish --port 6379 --messages 20000
+"""
+import argparse
+import time
+
+import redis
+
+import streams
+
+from consumer import StreamConsumer
+
+
+def _events(count: int, payload_size: int):
+    payload = "x" * payload_size
+    for i in range(count):
+        yield {"seq": i, "payload": payload}
+
+
+def run(client: redis.Redis, messages: int, payload_size: int,
+        batch_sizes) -> None:
+    consumer = StreamConsumer(client)
+    channel = consumer.setup()
+    try:
+        start = time.perf_counter()
+        for data in _events(messages, payload_size):
+            consumer.consume(data)
+        elapsed = time.perf_counter() - start
+        print(f"single      : {messages / elapsed:12.0f} msgs/s")
+        for batch in batch_sizes:
+            client.delete(channel)
+            start = time.perf_counter()
+            ids = consumer.consume_many(_events(messages, payload_size),
+                                        max_batch=batch)
+            elapsed = time.perf_counter() - start
+            assert len(ids) == messages
+            print(f"batch={batch:<6}: {messages / elapsed:12.0f} msgs/s")
+    finally:
+        client.delete(channel, streams.meta_key(channel))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--payload-size", type=int, default=128)
+    parser.add_argument("--batch-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[10, 100, 500, 1000])
+    args = parser.parse_args()
+    client = redis.Redis(host=args.host, port=args.port)
+    run(client, args.messages, args.payload_size, args.batch_sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Measures bytes per message in redis and encode/decode throughput per codec.
+
+Run against a local redis-server from the repository root:
+
+    python -m benchmarks.codec_compare --port 6379 --messages 10000
+"""
+import argparse
+import time
+
+import redis
+
+import codec
+import streams
+from consumer import StreamConsumer
+
+
+def _event(payload_size: int, seq: int = 0) -> dict:
+    return {
+        "seq": seq,
+        "type": "order.created",
+        "tenant": "acme",
+        "payload": ("lorem ipsum " * (payload_size // 12 + 1))[:payload_size],
+    }
+
+
+def _available_codecs():
+    for name in codec.CODECS:
+        try:
+            yield codec.get_codec(name)
+        except ImportError:
+            print(f"{name:<14}: skipped, dependency missing")
+
+
+def throughput(codec_: codec.Codec, payload_size: int, iterations: int):
+    """Returns encode and decode operations per second."""
+    data = _event(payload_size)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        payload = codec_.encode(data)
+    encode_rate = iterations / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec_.decode(payload)
+    decode_rate = iterations / (time.perf_counter() - start)
+    return encode_rate, decode_rate
+
+
+def bytes_per_message(client: redis.Redis, codec_, messages: int,
+                      payload_size: int) -> float:
+    """Returns `MEMORY USAGE` of a stream of `messages` events per event.
+
+  `codec_` None stores the event as str-encoded stream fields instead.
+  """
+    consumer = StreamConsumer(client, codec=codec_)
+    channel = consumer.setup()
+    try:
+        events = (_event(payload_size, i) for i in range(messages))
+        if codec_ is None:
+            pipe = client.pipeline(transaction=False)
+            for data in events:
+                pipe.xadd(channel, data)
+            pipe.execute()
+        else:
+            consumer.consume_many(events)
+        return client.memory_usage(channel, samples=0) / messages
+    finally:
+        client.delete(channel, streams.meta_key(channel))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=50000)
+    parser.add_argument("--payload-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[64, 512, 4096])
+    args = parser.parse_args()
+    client = redis.Redis(host=args.host, port=args.port)
+    codecs = list(_available_codecs())
+    for size in args.payload_sizes:
+        print(f"payload={size}B")
+        raw = bytes_per_message(client, None, args.messages, size)
+        print(f"  {'fields':<14}: {raw:10.1f} B/msg")
+        for codec_ in codecs:
+            used = bytes_per_message(client, codec_, args.messages, size)
+            encode_rate, decode_rate = throughput(codec_, size,
+                                                  args.iterations)
+            print(f"  {codec_.name:<14}: {used:10.1f} B/msg"
+                  f" {encode_rate:12.0f} enc/s {decode_rate:12.0f} dec/s")
+
+
+if __name__ == "__main__":
+    main()
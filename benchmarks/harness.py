@@ -0,0 +1,218 @@
+"""Load-testing harness for the Streams and pub/sub delivery paths.
+
+Each scenario publishes `messages` events spread over `channels` channels in
+batches of `batch_size` and delivers them to `consumers` producers per
+channel, each on its own thread. Streams producers of a channel share a
+consumer group, so every message is delivered once; pub/sub subscribers each
+receive every message. Events carry their publish time, which gives exact
+delivery latencies within the process.
+"""
+import itertools
+import json
+import platform
+import statistics
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import redis
+
+import streams
+from consumer import PubSubConsumer, StreamConsumer
+from producer import PubSubMultiplexer, PubSubProducer, StreamProducer
+
+STREAMS = "streams"
+PUBSUB = "pubsub"
+MODES = (STREAMS, PUBSUB)
+
+
+class Scenario(NamedTuple):
+    mode: str
+    payload_size: int
+    batch_size: int
+    channels: int
+    consumers: int
+    messages: int
+
+
+def matrix(modes: Iterable[str] = MODES,
+           payload_sizes: Iterable[int] = (128, ),
+           batch_sizes: Iterable[int] = (1, 100),
+           channels: Iterable[int] = (1, ),
+           consumers: Iterable[int] = (1, ),
+           messages: int = 10000) -> List[Scenario]:
+    """Returns every combination of the given parameters."""
+    return [
+        Scenario(*combination, messages)
+        for combination in itertools.product(modes, payload_sizes,
+                                             batch_sizes, channels, consumers)
+    ]
+
+
+class _Collector:
+    """Counts deliveries and their latencies across consumer threads."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.latencies: List[float] = []
+        self.last_delivery = 0.0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, messages) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            self.latencies.extend(now - message.data["t"]
+                                  for message in messages)
+            self.last_delivery = now
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+
+def _events(count: int, payload_size: int):
+    payload = "x" * payload_size
+    for _ in range(count):
+        yield {"t": time.perf_counter(), "p": payload}
+
+
+def _publish(consumers: list, scenario: Scenario) -> None:
+    per_channel = scenario.messages // len(consumers)
+    for consumer in consumers:
+        events = _events(per_channel, scenario.payload_size)
+        if scenario.batch_size == 1:
+            for data in events:
+                consumer.consume(data)
+        else:
+            consumer.consume_many(events, max_batch=scenario.batch_size)
+
+
+def _drain_stream(producer: StreamProducer, collector: _Collector,
+                  batch_size: int) -> None:
+    while not collector.done.is_set():
+        messages = producer.fetch(batch_size, block_ms=100)
+        if messages:
+            producer.ack(*(message.id for message in messages))
+            collector.record(messages)
+
+
+def _drain_pubsub(producer: PubSubProducer, collector: _Collector) -> None:
+    while not collector.done.is_set():
+        message = producer.subscription.get(timeout=0.1)
+        if message is not None:
+            collector.record((message, ))
+
+
+def run(client: redis.Redis, scenario: Scenario,
+        timeout: float = 60.0) -> Dict:
+    """Runs `scenario` against `client` and returns its measurements."""
+    per_channel = scenario.messages // scenario.channels
+    published = per_channel * scenario.channels
+    expected = published * (scenario.consumers
+                            if scenario.mode == PUBSUB else 1)
+    collector = _Collector(expected)
+    channels = [streams.new_channel() for _ in range(scenario.channels)]
+    threads = []
+    producers: list = []
+    multiplexer = None
+    if scenario.mode == STREAMS:
+        publishers = [StreamConsumer(client) for _ in channels]
+        for channel in channels:
+            for _ in range(scenario.consumers):
+                producer = StreamProducer(client, claim_interval=None)
+                producer.setup(channel)
+                producers.append(producer)
+                threads.append(
+                    threading.Thread(target=_drain_stream,
+                                     args=(producer, collector,
+                                           max(scenario.batch_size, 10))))
+    elif scenario.mode == PUBSUB:
+        publishers = [PubSubConsumer(client) for _ in channels]
+        multiplexer = PubSubMultiplexer(client)
+        for channel in channels:
+            for _ in range(scenario.consumers):
+                producer = PubSubProducer(multiplexer, maxsize=published)
+                producer.setup(channel)
+                producers.append(producer)
+                threads.append(
+                    threading.Thread(target=_drain_pubsub,
+                                     args=(producer, collector)))
+    else:
+        raise ValueError(f"Unknown mode: {scenario.mode!r}")
+    for publisher, channel in zip(publishers, channels):
+        publisher.setup(channel)
+    for thread in threads:
+        thread.start()
+    if multiplexer is not None:
+        _await_subscriptions(client, channels)
+    try:
+        start = time.perf_counter()
+        _publish(publishers, scenario)
+        delivered_all = collector.done.wait(timeout)
+    finally:
+        collector.done.set()
+        for thread in threads:
+            thread.join()
+    elapsed = max(collector.last_delivery - start, 1e-9)
+    latencies = collector.latencies
+    result = dict(scenario._asdict())
+    result.update(
+        delivered=len(latencies),
+        expected=expected,
+        complete=delivered_all,
+        msgs_per_s=len(latencies) / elapsed,
+        p50_ms=_percentile_ms(latencies, 0.50),
+        p99_ms=_percentile_ms(latencies, 0.99),
+        bytes_per_msg=None,
+        dropped=0,
+    )
+    if scenario.mode == STREAMS:
+        memory = sum(
+            client.memory_usage(channel, samples=0) or 0
+            for channel in channels)
+        result["bytes_per_msg"] = memory / max(published, 1)
+    for producer in producers:
+        if isinstance(producer, PubSubProducer):
+            result["dropped"] += producer.subscription.dropped
+        producer.close()
+    if multiplexer is not None:
+        multiplexer.close()
+    client.delete(*channels, *(streams.meta_key(c) for c in channels))
+    return result
+
+
+def run_all(client: redis.Redis, scenarios: Iterable[Scenario]) -> Dict:
+    """Runs `scenarios` and returns a JSON-ready report."""
+    return {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis": client.info("server")["redis_version"],
+        },
+        "results": [run(client, scenario) for scenario in scenarios],
+    }
+
+
+def write(report: Dict, path: str) -> None:
+    with open(path, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+def _await_subscriptions(client: redis.Redis,
+                         channels: List[str],
+                         timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = dict(client.pubsub_numsub(*channels))
+        if all(counts.get(channel.encode()) for channel in channels):
+            return
+        time.sleep(0.01)
+
+
+def _percentile_ms(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0] * 1000
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[int(q * 100) - 1] * 1000
@@ -0,0 +1,57 @@
+"""Spawns a throwaway local redis-server for benchmarks."""
+import contextlib
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from typing import Iterator, Optional
+
+import redis
+
+
+def available(executable: str = "redis-server") -> bool:
+    """Whether `executable` is on the PATH."""
+    return shutil.which(executable) is not None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def spawn(executable: str = "redis-server",
+          port: Optional[int] = None,
+          timeout: float = 10.0) -> Iterator[redis.Redis]:
+    """Runs a persistence-free redis-server and yields a client of it."""
+    port = port or free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(
+            [
+                executable, "--port",
+                str(port), "--bind", "127.0.0.1", "--save", "",
+                "--appendonly", "no", "--dir", workdir
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        client = redis.Redis(host="127.0.0.1", port=port)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    client.ping()
+                    break
+                except redis.ConnectionError:
+                    if (process.poll() is not None
+                            or time.monotonic() > deadline):
+                        raise RuntimeError(
+                            f"{executable} did not start on port {port}.")
+                    time.sleep(0.05)
+            yield client
+        finally:
+            client.close()
+            process.terminate()
+            process.wait(timeout)
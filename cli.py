@@ -0,0 +1,113 @@
+"""Command line entry point, `rmqdelivery <command>`."""
+import argparse
+import logging
+from typing import List, Optional
+
+import producer
+import sharding
+import streams
+import worker
+
+
+def rebalance(args: argparse.Namespace) -> int:
+    old = sharding.ShardRouter(args.source)
+    new = sharding.ShardRouter(args.target)
+    moved = sharding.rebalance(old, new, dry_run=args.dry_run)
+    verb = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{verb} {len(moved)} channel(s).")
+    for channel in moved:
+        source, target = old.node_for(channel), new.node_for(channel)
+        print(f"  {channel}: {source} -> {target}")
+    return 0
+
+
+def run_worker(args: argparse.Namespace) -> int:
+    source = producer.StreamProducer(
+        group=args.group,
+        consumer=args.consumer,
+        count=args.batch_size,
+        claim_min_idle_ms=args.claim_min_idle_ms,
+        max_deliveries=args.max_deliveries,
+        dead_letter=args.dead_letter)
+    source.setup(args.channel)
+    runtime = worker.Worker(source,
+                            worker.load_handler(args.handler),
+                            executor=args.executor,
+                            concurrency=args.concurrency,
+                            batch_size=args.batch_size,
+                            max_in_flight=args.max_in_flight)
+    runtime.install_signal_handlers()
+    runtime.run()
+    print(f"Handled {runtime.handled} message(s).")
+    return 0
+
+
+def parser() -> argparse.ArgumentParser:
+    root = argparse.ArgumentParser(prog="rmqdelivery")
+    commands = root.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser(
+        "rebalance",
+        help="Migrate channels to the node they map to in a new node set.")
+    command.add_argument("--from",
+                         dest="source",
+                         nargs="+",
+                         required=True,
+                         metavar="URL",
+                         help="Redis URLs of the current nodes.")
+    command.add_argument("--to",
+                         dest="target",
+                         nargs="+",
+                         required=True,
+                         metavar="URL",
+                         help="Redis URLs of the new nodes.")
+    command.add_argument("--dry-run",
+                         action="store_true",
+                         help="Only list the channels that would move.")
+    command.set_defaults(run=rebalance)
+
+    command = commands.add_parser(
+        "worker", help="Handle the messages of a channel in parallel.")
+    command.add_argument("channel")
+    command.add_argument("--handler",
+                         required=True,
+                         metavar="MODULE:FUNCTION",
+                         help="Callable invoked with each message.")
+    command.add_argument("--group", default=streams.DEFAULT_GROUP)
+    command.add_argument("--consumer",
+                         help="Consumer name, unique per worker by default.")
+    command.add_argument("--executor",
+                         choices=(worker.THREAD, worker.PROCESS),
+                         default=worker.THREAD)
+    command.add_argument("--concurrency",
+                         type=int,
+                         help="Pool size, the number of CPUs by default.")
+    command.add_argument("--batch-size",
+                         type=int,
+                         default=worker.DEFAULT_BATCH_SIZE)
+    command.add_argument("--max-in-flight",
+                         type=int,
+                         default=worker.DEFAULT_MAX_IN_FLIGHT)
+    command.add_argument("--claim-min-idle-ms",
+                         type=int,
+                         default=producer.DEFAULT_CLAIM_MIN_IDLE_MS,
+                         help="Reclaim pending messages idle this long.")
+    command.add_argument("--max-deliveries",
+                         type=int,
+                         default=producer.DEFAULT_MAX_DELIVERIES,
+                         help="Give up on messages delivered this often.")
+    command.add_argument("--dead-letter",
+                         metavar="STREAM",
+                         help="Stream receiving the messages given up on.")
+    command.set_defaults(run=run_worker)
+    return root
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    args = parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,205 @@
+"""Message codecs storing each event as one binary stream field.
+
+The codec of a channel is negotiated once, when the first consumer of the
+channel is set up, and recorded in the channel's metadata hash so that both
+ends agree on it. Producers only look the recorded codec up, and do so
+again on their first message if no consumer was set up before them.
+"""
+import json
+from typing import Callable, Dict, Optional, Union
+
+import redis
+
+from streams import meta_key, text
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+# Name of the single stream field holding an encoded event.
+FIELD = b"d"
+_TEXT_FIELD = FIELD.decode()
+DEFAULT_CODEC = "json"
+DEFAULT_ZSTD_THRESHOLD = 512
+
+
+class Codec:
+    """Encodes events to bytes and back."""
+    name = ""
+
+    def encode(self, data: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload: bytes) -> dict:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """JSON, using `orjson` when it is installed."""
+    name = "json"
+
+    def encode(self, data: dict) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def decode(self, payload: bytes) -> dict:
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload)
+
+
+class MsgpackCodec(Codec):
+    """MessagePack. Requires the `msgpack` package."""
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires `msgpack`.")
+
+    def encode(self, data: dict) -> bytes:
+        return msgpack.packb(data)
+
+    def decode(self, payload: bytes) -> dict:
+        return msgpack.unpackb(payload)
+
+
+class ZstdCodec(Codec):
+    """Compresses the output of `inner` with zstd above `threshold` bytes.
+
+  Payloads carry a one byte header telling whether they are compressed, so
+  decoding does not depend on the threshold. Requires `zstandard`.
+  """
+    _RAW = b"\x00"
+    _COMPRESSED = b"\x01"
+
+    def __init__(self,
+                 inner: Optional[Codec] = None,
+                 threshold: int = DEFAULT_ZSTD_THRESHOLD,
+                 level: int = 3):
+        if zstandard is None:
+            raise ImportError("The zstd codec requires `zstandard`.")
+        self.inner = inner or JsonCodec()
+        self.name = f"zstd+{self.inner.name}"
+        self.threshold = threshold
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, data: dict) -> bytes:
+        payload = self.inner.encode(data)
+        if len(payload) < self.threshold:
+            return self._RAW + payload
+        return self._COMPRESSED + self._compressor.compress(payload)
+
+    def decode(self, payload: bytes) -> dict:
+        header, body = payload[:1], payload[1:]
+        if header == self._COMPRESSED:
+            body = self._decompressor.decompress(body)
+        return self.inner.decode(body)
+
+
+CODECS: Dict[str, Callable[[], Codec]] = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+    "zstd+json": lambda: ZstdCodec(JsonCodec()),
+    "zstd+msgpack": lambda: ZstdCodec(MsgpackCodec()),
+}
+
+t_codec = Union[str, Codec, None]
+
+
+def get_codec(codec: t_codec = None) -> Codec:
+    """Returns the codec registered as `codec`, or `codec` itself."""
+    if isinstance(codec, Codec):
+        return codec
+    name = codec or DEFAULT_CODEC
+    try:
+        factory = CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec: {name!r}") from None
+    return factory()
+
+
+def negotiate(client: redis.Redis, channel: str,
+              preferred: t_codec = None) -> Codec:
+    """Records `preferred` as the codec of `channel` unless one is recorded.
+
+  Returns the codec the channel actually uses. A `preferred` codec instance
+  is kept as is when its name wins, preserving its settings. Raises
+  ValueError when an explicitly `preferred` codec loses to another one.
+  """
+    wanted = get_codec(preferred)
+    key = meta_key(channel)
+    pipe = client.pipeline(transaction=False)
+    pipe.hsetnx(key, "codec", wanted.name)
+    pipe.hget(key, "codec")
+    _, recorded = pipe.execute()
+    return _resolve(channel, recorded, wanted, preferred)
+
+
+async def anegotiate(client, channel: str,
+                     preferred: t_codec = None) -> Codec:
+    """asyncio counterpart of `negotiate`."""
+    wanted = get_codec(preferred)
+    key = meta_key(channel)
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.hsetnx(key, "codec", wanted.name)
+        pipe.hget(key, "codec")
+        _, recorded = await pipe.execute()
+    return _resolve(channel, recorded, wanted, preferred)
+
+
+def lookup(client: redis.Redis, channel: str) -> Optional[Codec]:
+    """Returns the codec recorded for `channel`, or None. Records nothing."""
+    recorded = client.hget(meta_key(channel), "codec")
+    return None if recorded is None else get_codec(text(recorded))
+
+
+async def alookup(client, channel: str) -> Optional[Codec]:
+    """asyncio counterpart of `lookup`."""
+    recorded = await client.hget(meta_key(channel), "codec")
+    return None if recorded is None else get_codec(text(recorded))
+
+
+def encode_fields(codec: Codec, data: dict) -> dict:
+    """Returns the stream fields storing `data`."""
+    return {FIELD: codec.encode(data)}
+
+
+def decode_fields(codec: Codec, fields: dict) -> dict:
+    """Returns the event stored in `fields`.
+
+  Entries written without a codec are returned as their raw fields. Clients
+  with `decode_responses=True` only work with the json codec, as the
+  payloads of the other codecs are not valid UTF-8.
+  """
+    payload = fields.get(FIELD)
+    if payload is None:
+        payload = fields.get(_TEXT_FIELD)
+        if payload is None:
+            return fields
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return codec.decode(payload)
+
+
+def _resolve(channel: str, recorded, wanted: Codec,
+             preferred: t_codec) -> Codec:
+    recorded = text(recorded)
+    if recorded == wanted.name:
+        return wanted
+    if preferred is not None:
+        raise ValueError(f"{channel} already uses the {recorded!r} codec, "
+                         f"not {wanted.name!r}.")
+    return get_codec(recorded)
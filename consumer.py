@@ -0,0 +1,246 @@
+import threading
+import time
+from typing import Iterable, List, Optional
+
+import redis
+
+import main
+import retention
+import streams
+from codec import Codec, encode_fields, negotiate, t_codec
+from interface import Consumer, t_consumer_id
+from metrics import BATCH_SIZE, ROUND_TRIP, MetricsSink
+from sharding import ShardRouter
+
+DEFAULT_MAX_BATCH = 500
+DEFAULT_MAX_LINGER_MS = 5
+# Seconds the metadata of a pub/sub channel outlives its last publisher.
+DEFAULT_PUBSUB_META_TTL = 3600
+
+
+class StreamConsumer(Consumer):
+    """Consumes input into a dedicated redis stream.
+
+  Single events are appended with one XADD each. `consume_many` buffers
+  events and sends them as one pipelined, non-transactional batch of XADDs.
+  A `retention` policy is recorded for the channel and, with `inline_trim`,
+  enforced on every XADD where the policy allows it. With a `router`, the
+  channel lives on the node it is routed to at `setup()` time.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.Redis] = None,
+                 max_batch: int = DEFAULT_MAX_BATCH,
+                 max_linger_ms: int = DEFAULT_MAX_LINGER_MS,
+                 codec: t_codec = None,
+                 retention: Optional[retention.RetentionPolicy] = None,
+                 inline_trim: bool = True,
+                 router: Optional[ShardRouter] = None,
+                 metrics: Optional[MetricsSink] = None):
+        self.client = client or main.redis_server
+        self.router = main.default_router(client, router)
+        self.max_batch = max_batch
+        self.max_linger_ms = max_linger_ms
+        self.preferred_codec = codec
+        self.codec: Optional[Codec] = None
+        self.retention = retention
+        self.inline_trim = inline_trim and retention is not None
+        self.metrics = metrics
+        self.channel: Optional[str] = None
+
+    def setup(self, channel: Optional[str] = None, **kwargs) -> t_consumer_id:
+        """Setup the consumer on `channel`, or on a freshly named one.
+
+    Negotiates the codec of the channel, see `codec.negotiate`, and records
+    its retention policy.
+    """
+        self.channel = channel or streams.new_channel()
+        if self.router is not None:
+            self.client = self.router.client_for(self.channel)
+        self.codec = negotiate(self.client, self.channel,
+                               self.preferred_codec)
+        if self.retention is not None:
+            retention.record(self.client, self.channel, self.retention)
+        return self.channel
+
+    def consume(self, data: dict, **optional_attrs) -> bytes:
+        """Append one event to the channel and return its stream id."""
+        if self.inline_trim:
+            optional_attrs = {
+                **self.retention.xadd_kwargs(),
+                **optional_attrs
+            }
+        channel = self._channel()
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        message_id = self.client.xadd(channel, encode_fields(self.codec, data),
+                                      **optional_attrs)
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=channel,
+                                 command="xadd")
+        return message_id
+
+    def consume_many(self,
+                     events: Iterable[dict],
+                     max_batch: Optional[int] = None,
+                     max_linger_ms: Optional[int] = None,
+                     **optional_attrs) -> List[bytes]:
+        """Append events in pipelined batches and return their stream ids.
+
+    The buffer is flushed once it holds `max_batch` events or once its
+    oldest event has waited `max_linger_ms`. A helper thread flushes on the
+    linger deadline, so a partly filled batch is sent on time even while
+    `events` blocks waiting for its next event. Ids are returned in the
+    order the events were given.
+    """
+        max_batch = max_batch or self.max_batch
+        if max_linger_ms is None:
+            max_linger_ms = self.max_linger_ms
+        linger = max_linger_ms / 1000.0
+        channel = self._channel()
+        ids: List[bytes] = []
+        buffer: List[dict] = []
+        deadline = 0.0
+        done = False
+        failed: List[Exception] = []
+        ready = threading.Condition(threading.Lock())
+
+        def flush() -> None:
+            nonlocal buffer
+            ids.extend(self._flush(channel, buffer, optional_attrs))
+            buffer = []
+
+        def flush_on_linger() -> None:
+            with ready:
+                while not done and not failed:
+                    if not buffer:
+                        ready.wait()
+                    elif time.monotonic() < deadline:
+                        ready.wait(deadline - time.monotonic())
+                    else:
+                        try:
+                            flush()
+                        except Exception as exc:
+                            failed.append(exc)
+
+        flusher = threading.Thread(target=flush_on_linger,
+                                   name=f"linger:{channel}",
+                                   daemon=True)
+        flusher.start()
+        try:
+            for data in events:
+                with ready:
+                    if failed:
+                        break
+                    if not buffer:
+                        deadline = time.monotonic() + linger
+                        ready.notify()
+                    buffer.append(data)
+                    if len(buffer) >= max_batch:
+                        flush()
+        finally:
+            with ready:
+                done = True
+                ready.notify()
+            flusher.join()
+        if failed:
+            raise failed[0]
+        if buffer:
+            flush()
+        return ids
+
+    def _flush(self, channel: str, buffer: List[dict],
+               optional_attrs: dict) -> List[bytes]:
+        if self.inline_trim:
+            optional_attrs = {
+                **self.retention.xadd_kwargs(),
+                **optional_attrs
+            }
+        pipe = self.client.pipeline(transaction=False)
+        for data in buffer:
+            pipe.xadd(channel, encode_fields(self.codec, data),
+                      **optional_attrs)
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        ids = pipe.execute()
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=channel,
+                                 command="pipeline")
+            self.metrics.observe(BATCH_SIZE, len(buffer), channel=channel)
+        return ids
+
+    def _channel(self) -> str:
+        if self.channel is None:
+            raise RuntimeError("Consumer.setup() must be called first.")
+        return self.channel
+
+
+class PubSubConsumer(Consumer):
+    """Consumes input into a redis pub/sub channel.
+
+  Delivery is at-most-once: events published while nobody is subscribed
+  are lost. The metadata hash of the channel expires `meta_ttl` seconds
+  after the last publish, refreshed every `meta_ttl / 2` seconds, so that
+  short-lived channels leave no keys behind.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.Redis] = None,
+                 codec: t_codec = None,
+                 router: Optional[ShardRouter] = None,
+                 meta_ttl: Optional[int] = DEFAULT_PUBSUB_META_TTL):
+        self.client = client or main.redis_server
+        self.router = main.default_router(client, router)
+        self.preferred_codec = codec
+        self.codec: Optional[Codec] = None
+        self.meta_ttl = meta_ttl
+        self.channel: Optional[str] = None
+        self._meta_refresh_at = 0.0
+
+    def setup(self, channel: Optional[str] = None, **kwargs) -> t_consumer_id:
+        """Setup the consumer on `channel`, or on a freshly named one."""
+        self.channel = channel or streams.new_channel()
+        if self.router is not None:
+            self.client = self.router.client_for(self.channel)
+        self.codec = negotiate(self.client, self.channel,
+                               self.preferred_codec)
+        self._meta_refresh_at = 0.0
+        self._refresh_meta()
+        return self.channel
+
+    def consume(self, data: dict, **optional_attrs) -> int:
+        """Publish one event and return the number of subscribers reached."""
+        if self.channel is None:
+            raise RuntimeError("Consumer.setup() must be called first.")
+        self._refresh_meta()
+        return self.client.publish(self.channel, self.codec.encode(data))
+
+    def consume_many(self,
+                     events: Iterable[dict],
+                     max_batch: int = DEFAULT_MAX_BATCH,
+                     **optional_attrs) -> List[int]:
+        """Publish events in pipelined batches of up to `max_batch`.
+
+    Returns the number of subscribers each event reached.
+    """
+        if self.channel is None:
+            raise RuntimeError("Consumer.setup() must be called first.")
+        self._refresh_meta()
+        reached: List[int] = []
+        pipe = self.client.pipeline(transaction=False)
+        for data in events:
+            pipe.publish(self.channel, self.codec.encode(data))
+            if len(pipe) >= max_batch:
+                reached.extend(pipe.execute())
+        if len(pipe):
+            reached.extend(pipe.execute())
+        return reached
+
+    def _refresh_meta(self) -> None:
+        now = time.monotonic()
+        if self.meta_ttl is None or now < self._meta_refresh_at:
+            return
+        self.client.expire(streams.meta_key(self.channel), self.meta_ttl)
+        self._meta_refresh_at = now + self.meta_ttl / 2
@@ -1,9 +1,20 @@
 import abc
-from typing import Protocol, Optional, TypeVar
+from typing import (AsyncIterator, NamedTuple, Protocol, Optional, TypeVar,
+                    Union)
 
 t_consumer_id = TypeVar('consumer_id', bound=str)
 
 
+class Message(NamedTuple):
+    """A single delivered entry of a channel.
+
+  `id` is the stream id, or None for pub/sub messages.
+  """
+    channel: str
+    id: Optional[Union[bytes, str]]
+    data: dict
+
+
 class Consumer(Protocol):
     """This class consumes input.
   Each consumer entry creates a dedicated channel to consume into.
@@ -35,3 +46,33 @@ class Producer(Protocol):
     def get(self, **optional_attrs) -> None:
         """Returns output."""
         raise NotImplementedError
+
+
+class AsyncConsumer(Protocol):
+    """asyncio counterpart of `Consumer`."""
+
+    @abc.abstractmethod
+    async def setup(self,
+                    channel: Optional[str] = None,
+                    **kwargs) -> t_consumer_id:
+        """Setup the consumer."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def consume(self, data: dict, **optional_attrs) -> None:
+        """Consume input."""
+        raise NotImplementedError
+
+
+class AsyncProducer(Protocol):
+    """asyncio counterpart of `Producer`."""
+
+    @abc.abstractmethod
+    async def setup(self, consumer_id: t_consumer_id, **kwargs) -> None:
+        """Setup the producer."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, **optional_attrs) -> AsyncIterator[Message]:
+        """Returns output as an async iterator."""
+        raise NotImplementedError
@@ -1,6 +1,57 @@
+import os
+from typing import Optional
+
 import redis
+import redis.asyncio
+
+import sharding
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+# Upper bound of connections shared by every asyncio consumer and producer.
+ASYNC_MAX_CONNECTIONS = 64
+# Comma separated redis URLs. When set, channels are sharded across them.
+REDIS_URLS = [
+    url for url in os.environ.get('RMQ_REDIS_URLS', '').split(',') if url
+]
+
+redis_server = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+redis_router: Optional[sharding.ShardRouter] = (
+    sharding.ShardRouter(REDIS_URLS) if REDIS_URLS else None)
+
+_async_pool: Optional[redis.asyncio.BlockingConnectionPool] = None
+
+
+def async_connection_pool() -> redis.asyncio.BlockingConnectionPool:
+    """Returns the process wide, bounded asyncio connection pool.
+
+  Callers beyond `ASYNC_MAX_CONNECTIONS` wait for a free connection instead
+  of opening a new one.
+  """
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = redis.asyncio.BlockingConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            timeout=None)
+    return _async_pool
+
 
-redis_server = redis.Redis(host='localhost', port=6379)
+def async_redis_server() -> redis.asyncio.Redis:
+    """Returns an asyncio client backed by the shared connection pool."""
+    return redis.asyncio.Redis(connection_pool=async_connection_pool())
 
 
+def default_router(
+        client=None,
+        router: Optional[sharding.ShardRouter] = None
+) -> Optional[sharding.ShardRouter]:
+    """Returns the router a consumer or producer resolves channels with.
 
+  An explicit `client` pins every channel to that client; otherwise
+  `router` or, failing that, the `RMQ_REDIS_URLS` router is used.
+  """
+    if router is not None or client is not None:
+        return router
+    return redis_router
@@ -0,0 +1,225 @@
+"""Delivery metrics of the Streams consumers and producers.
+
+Consumers and producers accept a `metrics` sink and only measure anything
+when one is given, so the hot path costs a single `is not None` check
+without one. Measurements:
+
+- `DELIVERY_LATENCY`: seconds from enqueue, taken from the timestamp part
+  of the stream id, to delivery. It compares the redis clock with the local
+  one, so it is only as accurate as their synchronisation.
+- `BATCH_SIZE`: entries per published or fetched batch.
+- `ROUND_TRIP`: seconds per redis call, labelled with the command. Blocking
+  reads are left out as their time is mostly spent waiting for entries.
+- `PENDING`: entries in the pending entries list of a consumer group,
+  reported at most every `PENDING_INTERVAL` seconds as messages are fetched
+  and acknowledged.
+"""
+import bisect
+import http.server
+import threading
+import time
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+DELIVERY_LATENCY = "rmq_delivery_latency_seconds"
+BATCH_SIZE = "rmq_batch_size"
+ROUND_TRIP = "rmq_redis_round_trip_seconds"
+PENDING = "rmq_pending_entries"
+PENDING_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_HELP = {
+    DELIVERY_LATENCY: "Seconds from enqueue to delivery.",
+    BATCH_SIZE: "Entries per published or fetched batch.",
+    ROUND_TRIP: "Seconds per redis round trip.",
+    PENDING: "Entries in the pending entries list of a consumer group.",
+}
+
+t_labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsSink:
+    """Receives measurements. Implementations must be thread-safe."""
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Records one sample of the histogram `name`."""
+        raise NotImplementedError
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        """Sets the gauge `name`."""
+        raise NotImplementedError
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket holding quantile `q`."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return float("inf")
+
+
+class InMemorySink(MetricsSink):
+    """Keeps histograms and gauges in memory."""
+
+    def __init__(self, buckets: Optional[Dict[str, Sequence[float]]] = None):
+        self.buckets = {
+            DELIVERY_LATENCY: LATENCY_BUCKETS,
+            ROUND_TRIP: LATENCY_BUCKETS,
+            BATCH_SIZE: SIZE_BUCKETS,
+        }
+        self.buckets.update(buckets or {})
+        self.histograms: Dict[str, Dict[t_labels, Histogram]] = {}
+        self.gauges: Dict[str, Dict[t_labels, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(
+                    self.buckets.get(name, LATENCY_BUCKETS))
+            series[key].observe(value)
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def histogram(self, name: str, **labels: str) -> Optional[Histogram]:
+        return self.histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def snapshot(self) -> Tuple[Dict[str, Dict[t_labels, Histogram]], Dict[
+            str, Dict[t_labels, float]]]:
+        """Returns consistent copies of the histograms and the gauges."""
+        with self._lock:
+            histograms = {
+                name: {
+                    labels: histogram.copy()
+                    for labels, histogram in series.items()
+                }
+                for name, series in self.histograms.items()
+            }
+            gauges = {
+                name: dict(series)
+                for name, series in self.gauges.items()
+            }
+        return histograms, gauges
+
+
+class PrometheusTextExporter:
+    """Renders an `InMemorySink` in the Prometheus text exposition format."""
+
+    def __init__(self, sink: InMemorySink):
+        self.sink = sink
+        self._server: Optional[http.server.HTTPServer] = None
+
+    def render(self) -> str:
+        lines = []
+        histograms, gauges = self.sink.snapshot()
+        for name, series in sorted(histograms.items()):
+            lines.extend(_header(name, "histogram"))
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket"
+                                 f"{_labels(labels, le=repr(bound))}"
+                                 f" {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels, le='+Inf')}"
+                             f" {histogram.count}")
+                lines.append(f"{name}_sum{_labels(labels)}"
+                             f" {histogram.sum!r}")
+                lines.append(f"{name}_count{_labels(labels)}"
+                             f" {histogram.count}")
+        for name, series in sorted(gauges.items()):
+            lines.extend(_header(name, "gauge"))
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(labels)} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "") -> None:
+        """Serves `render()` over HTTP from a daemon thread."""
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever,
+                         name="metrics-exporter",
+                         daemon=True).start()
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+def stream_id_seconds(stream_id) -> float:
+    """Returns the enqueue time encoded in `stream_id`, in epoch seconds."""
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode()
+    return int(stream_id.partition("-")[0]) / 1000.0
+
+
+def observe_delivery(sink: MetricsSink, channel: str,
+                     stream_ids: Iterable) -> None:
+    """Records the delivery latency of `stream_ids` delivered just now."""
+    now = time.time()
+    for stream_id in stream_ids:
+        sink.observe(DELIVERY_LATENCY,
+                     max(now - stream_id_seconds(stream_id), 0.0),
+                     channel=channel)
+
+
+def _header(name: str, kind: str) -> list:
+    return [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} {kind}"]
+
+
+def _labels(labels: t_labels, **extra: str) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"'
+                          for (key, _), value in zip(pairs, escaped)) + "}"
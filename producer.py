@@ -0,0 +1,556 @@
+import collections
+import logging
+import threading
+import time
+from typing import Deque, Dict, Iterator, List, Optional, Set
+
+import redis
+
+import main
+import streams
+from codec import Codec, decode_fields, get_codec, lookup
+from interface import Message, Producer, t_consumer_id
+from metrics import (BATCH_SIZE, PENDING, PENDING_INTERVAL, ROUND_TRIP,
+                     MetricsSink, observe_delivery)
+from sharding import ShardRouter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNT = 100
+DEFAULT_BLOCK_MS = 5000
+DEFAULT_CLAIM_MIN_IDLE_MS = 60000
+DEFAULT_CLAIM_INTERVAL = 30.0
+DEFAULT_MAX_DELIVERIES = 10
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DEFAULT_MAXSIZE = 1000
+
+
+class StreamProducer(Producer):
+    """Produces output from a channel through a redis consumer group.
+
+  Messages are read with `XREADGROUP COUNT n BLOCK ms` and acknowledged with
+  one XACK per batch, giving at-least-once delivery. A background sweep
+  claims entries that other consumers of the group left pending for longer
+  than `claim_min_idle_ms` (e.g. because they crashed) and delivers them
+  again through this producer. Entries the producer handed out are not
+  claimed back while it holds them, i.e. until they are acknowledged or
+  `release`d, however long the caller takes. Entries delivered
+  `max_deliveries` times, and entries that cannot be decoded, are
+  acknowledged without being delivered (again), after being copied to the
+  `dead_letter` stream if one is given.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.Redis] = None,
+                 group: str = streams.DEFAULT_GROUP,
+                 consumer: Optional[str] = None,
+                 count: int = DEFAULT_COUNT,
+                 block_ms: int = DEFAULT_BLOCK_MS,
+                 auto_ack: bool = True,
+                 claim_min_idle_ms: int = DEFAULT_CLAIM_MIN_IDLE_MS,
+                 claim_interval: Optional[float] = DEFAULT_CLAIM_INTERVAL,
+                 max_deliveries: Optional[int] = DEFAULT_MAX_DELIVERIES,
+                 dead_letter: Optional[str] = None,
+                 router: Optional[ShardRouter] = None,
+                 metrics: Optional[MetricsSink] = None):
+        self.client = client or main.redis_server
+        self.router = main.default_router(client, router)
+        self.metrics = metrics
+        self.group = group
+        self.consumer = consumer or streams.consumer_name()
+        self.count = count
+        self.block_ms = block_ms
+        self.auto_ack = auto_ack
+        self.claim_min_idle_ms = claim_min_idle_ms
+        self.claim_interval = claim_interval
+        self.max_deliveries = max_deliveries
+        self.dead_letter = dead_letter
+        self.channel: Optional[str] = None
+        self.codec: Optional[Codec] = None
+        self._reclaimed: Deque[Message] = collections.deque()
+        self._held: Set = set()
+        self._pending_reported = 0.0
+        self._closed = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def setup(self, consumer_id: t_consumer_id, **kwargs) -> None:
+        """Setup the producer on the channel of `consumer_id`.
+
+    Resolves the node of the channel through the router, if any, creates the
+    consumer group (and the stream) if they do not exist yet, looks up the
+    codec of the channel and starts the reclaim sweep unless
+    `claim_interval` is None.
+    """
+        self.channel = consumer_id
+        if self.router is not None:
+            self.client = self.router.client_for(consumer_id)
+        self.codec = lookup(self.client, consumer_id)
+        try:
+            self.client.xgroup_create(consumer_id,
+                                      self.group,
+                                      id="0",
+                                      mkstream=True)
+        except redis.ResponseError as exc:
+            if not streams.is_busygroup(exc):
+                raise
+        if self.claim_interval is not None and self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep,
+                                             name=f"reclaim:{consumer_id}",
+                                             daemon=True)
+            self._sweeper.start()
+
+    def get(self,
+            count: Optional[int] = None,
+            block_ms: Optional[int] = None,
+            **optional_attrs) -> Iterator[Message]:
+        """Lazily yields messages until the producer is closed.
+
+    With `auto_ack`, a message is acknowledged once the caller asks for the
+    next one; acknowledgements are sent as one XACK per fetched batch.
+    """
+        processed: List[bytes] = []
+        try:
+            while not self._closed.is_set():
+                for message in self.fetch(count, block_ms):
+                    yield message
+                    if self.auto_ack:
+                        processed.append(message.id)
+                if processed:
+                    self.ack(*processed)
+                    processed = []
+        finally:
+            if processed:
+                self.ack(*processed)
+
+    def fetch(self,
+              count: Optional[int] = None,
+              block_ms: Optional[int] = None) -> List[Message]:
+        """Returns the next batch of at most `count` messages.
+
+    Reclaimed messages are handed out before new ones. Returns an empty list
+    when nothing arrived within `block_ms`.
+    """
+        channel = self._channel()
+        count = count or self.count
+        if self._reclaimed:
+            batch: List[Message] = []
+            while self._reclaimed and len(batch) < count:
+                batch.append(self._reclaimed.popleft())
+        else:
+            response = self.client.xreadgroup(
+                self.group,
+                self.consumer, {channel: ">"},
+                count=count,
+                block=self.block_ms if block_ms is None else block_ms)
+            batch = self._messages([
+                entry for _, entries in response or () for entry in entries
+            ])
+        self._held.update(message.id for message in batch)
+        if self.metrics is not None and batch:
+            self.metrics.observe(BATCH_SIZE, len(batch), channel=channel)
+            observe_delivery(self.metrics, channel,
+                             (message.id for message in batch))
+        self._report_pending()
+        return batch
+
+    def ack(self, *message_ids) -> int:
+        """Acknowledges `message_ids` in one XACK."""
+        if not message_ids:
+            return 0
+        channel = self._channel()
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        acked = self.client.xack(channel, self.group, *message_ids)
+        if self.metrics is not None:
+            self.metrics.observe(ROUND_TRIP,
+                                 time.perf_counter() - start,
+                                 channel=channel,
+                                 command="xack")
+            self._report_pending()
+        self._held.difference_update(message_ids)
+        return acked
+
+    def release(self, *message_ids) -> None:
+        """Gives up `message_ids` without acknowledging them.
+
+    They stay pending and are delivered again by the reclaim sweep of any
+    consumer of the group, this one included, once idle.
+    """
+        self._held.difference_update(message_ids)
+
+    def touch(self, *message_ids) -> None:
+        """Resets the idle time of `message_ids` with `XCLAIM … JUSTID`.
+
+    Keeps other consumers from claiming messages that are still waiting to
+    be processed for longer than `claim_min_idle_ms`.
+    """
+        if message_ids:
+            self.client.xclaim(self._channel(),
+                               self.group,
+                               self.consumer,
+                               0,
+                               list(message_ids),
+                               justid=True)
+
+    def reclaim(self, max_messages: Optional[int] = None) -> int:
+        """Claims idle pending entries of the group once.
+
+    Entries idle for at least `claim_min_idle_ms` are listed with XPENDING
+    and claimed with XCLAIM, except those this producer holds. Claimed
+    messages are queued for the next `fetch`; entries deleted from the
+    stream while pending are dropped by redis. Returns the number of
+    messages queued.
+    """
+        channel = self._channel()
+        max_messages = max_messages or self.count * 10
+        start = "-"
+        claimed = 0
+        while claimed < max_messages:
+            entries = self.client.xpending_range(channel,
+                                                 self.group,
+                                                 min=start,
+                                                 max="+",
+                                                 count=self.count,
+                                                 idle=self.claim_min_idle_ms)
+            if not entries:
+                break
+            start = f"({streams.text(entries[-1]['message_id'])}"
+            retry, exhausted = [], []
+            for entry in entries:
+                if entry["message_id"] in self._held:
+                    continue
+                if (self.max_deliveries is not None and
+                        entry["times_delivered"] >= self.max_deliveries):
+                    exhausted.append(entry["message_id"])
+                else:
+                    retry.append(entry["message_id"])
+            if exhausted:
+                self._give_up(exhausted)
+            for message in self._messages(self._claim(retry)):
+                self._reclaimed.append(message)
+                self._held.add(message.id)
+                claimed += 1
+            if len(entries) < self.count:
+                break
+        return claimed
+
+    def pending(self) -> int:
+        """Returns the size of the group's pending entries list.
+
+    The size is also reported to the metrics sink, if any. With a sink, it
+    is reported at most every `metrics.PENDING_INTERVAL` seconds as messages
+    are fetched and acknowledged, and on each run of the reclaim sweep.
+    """
+        channel = self._channel()
+        depth = self.client.xpending(channel, self.group)["pending"]
+        if self.metrics is not None:
+            self.metrics.set_gauge(PENDING,
+                                   depth,
+                                   channel=channel,
+                                   group=self.group)
+        return depth
+
+    def close(self) -> None:
+        """Stops `get` after its current read and stops the reclaim sweep."""
+        self._closed.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def _sweep(self) -> None:
+        while not self._closed.wait(self.claim_interval):
+            try:
+                if self.metrics is not None:
+                    self.pending()
+                if len(self._reclaimed) < self.count:
+                    self.reclaim()
+            except Exception:
+                logger.exception("Reclaim sweep of %s failed.", self.channel)
+
+    def _report_pending(self) -> None:
+        if self.metrics is None:
+            return
+        now = time.monotonic()
+        if now - self._pending_reported >= PENDING_INTERVAL:
+            self._pending_reported = now
+            try:
+                self.pending()
+            except redis.RedisError:
+                logger.exception("Reporting the pending entries of %s "
+                                 "failed.", self.channel)
+
+    def _messages(self, entries: list) -> List[Message]:
+        """Decodes `entries`, discarding those that cannot be decoded."""
+        if not entries:
+            return []
+        channel = self._channel()
+        if self.codec is None:
+            # No consumer was set up before this producer; one has been by
+            # the time an entry arrives.
+            self.codec = lookup(self.client, channel) or get_codec()
+        messages, undecodable = [], []
+        for message_id, fields in entries:
+            try:
+                data = decode_fields(self.codec, fields)
+            except Exception:
+                logger.exception("Discarding %s of %s: it cannot be decoded.",
+                                 streams.text(message_id), channel)
+                undecodable.append((message_id, fields))
+                continue
+            messages.append(Message(channel, message_id, data))
+        self._discard(undecodable)
+        return messages
+
+    def _claim(self, message_ids: list) -> list:
+        if not message_ids:
+            return []
+        return [(message_id, fields)
+                for message_id, fields in self.client.xclaim(
+                    self._channel(), self.group, self.consumer,
+                    self.claim_min_idle_ms, message_ids)
+                if fields is not None]
+
+    def _give_up(self, message_ids: list) -> None:
+        """Acknowledges entries delivered `max_deliveries` times."""
+        entries = self._claim(message_ids)
+        for message_id, _ in entries:
+            logger.warning("Giving up on %s of %s after %d deliveries.",
+                           streams.text(message_id), self.channel,
+                           self.max_deliveries)
+        self._discard(entries)
+
+    def _discard(self, entries: list) -> None:
+        """Acknowledges `entries` after copying them to `dead_letter`."""
+        if not entries:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        if self.dead_letter is not None:
+            for _, fields in entries:
+                pipe.xadd(self.dead_letter, fields)
+        pipe.xack(self._channel(), self.group,
+                  *(message_id for message_id, _ in entries))
+        pipe.execute()
+
+    def _channel(self) -> str:
+        if self.channel is None:
+            raise RuntimeError("Producer.setup() must be called first.")
+        return self.channel
+
+
+class Subscription:
+    """Bounded in-memory queue of one local pub/sub subscriber.
+
+  When the queue is full, `policy` decides whether the oldest queued
+  message or the incoming one is dropped; `dropped` counts both, as well as
+  messages that never reached the queue, see `drop`.
+  """
+
+    def __init__(self,
+                 channel: str,
+                 maxsize: int = DEFAULT_MAXSIZE,
+                 policy: str = DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown drop policy: {policy!r}")
+        self.channel = channel
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._messages: Deque[Message] = collections.deque()
+        self._ready = threading.Condition()
+
+    def put(self, message: Message) -> None:
+        """Queues `message`, dropping one message if the queue is full."""
+        with self._ready:
+            if len(self._messages) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                self._messages.popleft()
+            self._messages.append(message)
+            self._ready.notify()
+
+    def drop(self) -> None:
+        """Counts a message lost before it could be queued."""
+        with self._ready:
+            self.dropped += 1
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """Returns the next message, or None on timeout or once closed."""
+        with self._ready:
+            self._ready.wait_for(lambda: self._messages or self.closed,
+                                 timeout)
+            return self._messages.popleft() if self._messages else None
+
+    def close(self) -> None:
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+
+
+class PubSubMultiplexer:
+    """Fans one pub/sub connection out to many local subscribers.
+
+  Each redis channel is subscribed once no matter how many local
+  subscribers it has. A listener thread decodes every message once and
+  hands it to each subscriber's bounded queue, so a slow subscriber only
+  drops its own messages and never stalls the connection. Messages that
+  cannot be decoded are logged and counted as dropped by every subscriber.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.Redis] = None,
+                 poll_interval: float = 0.1):
+        self.client = client or main.redis_server
+        self.poll_interval = poll_interval
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._subscribers: Dict[str, List[Subscription]] = {}
+        self._codecs: Dict[str, Optional[Codec]] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._listener: Optional[threading.Thread] = None
+
+    def subscribe(self,
+                  channel: str,
+                  maxsize: int = DEFAULT_MAXSIZE,
+                  policy: str = DROP_OLDEST) -> Subscription:
+        """Returns a new local subscription to `channel`."""
+        subscription = Subscription(channel, maxsize, policy)
+        codec = lookup(self.client, channel)
+        with self._lock:
+            subscribers = self._subscribers.setdefault(channel, [])
+            if not subscribers:
+                self._codecs[channel] = codec
+                self._pubsub.subscribe(channel)
+            subscribers.append(subscription)
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  name="pubsub-multiplexer",
+                                                  daemon=True)
+                self._listener.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Removes `subscription`, unsubscribing its channel if unused."""
+        subscription.close()
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel, [])
+            if subscription in subscribers:
+                subscribers.remove(subscription)
+            if not subscribers and subscription.channel in self._subscribers:
+                del self._subscribers[subscription.channel]
+                del self._codecs[subscription.channel]
+                self._pubsub.unsubscribe(subscription.channel)
+
+    def close(self) -> None:
+        """Stops the listener and closes the pub/sub connection."""
+        self._closed.set()
+        if self._listener is not None:
+            self._listener.join()
+            self._listener = None
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                for subscription in subscribers:
+                    subscription.close()
+            self._subscribers.clear()
+            self._codecs.clear()
+        self._pubsub.close()
+
+    def _listen(self) -> None:
+        while not self._closed.is_set():
+            try:
+                raw = self._pubsub.get_message(timeout=self.poll_interval)
+            except redis.RedisError:
+                logger.exception("Pub/sub listener failed.")
+                self._closed.wait(self.poll_interval)
+                continue
+            if raw is None or raw["type"] != "message":
+                continue
+            channel = streams.channel_name(raw["channel"])
+            with self._lock:
+                subscribers = list(self._subscribers.get(channel, ()))
+                codec = self._codecs.get(channel)
+            if not subscribers:
+                continue
+            try:
+                if codec is None:
+                    codec = lookup(self.client, channel) or get_codec()
+                    with self._lock:
+                        if channel in self._codecs:
+                            self._codecs[channel] = codec
+                message = Message(channel, None, codec.decode(raw["data"]))
+            except Exception:
+                logger.exception("Dropping a message of %s: it cannot be "
+                                 "decoded.", channel)
+                for subscription in subscribers:
+                    subscription.drop()
+                continue
+            for subscription in subscribers:
+                subscription.put(message)
+
+
+_pubsub_multiplexers: Dict[int, PubSubMultiplexer] = {}
+_pubsub_multiplexer_lock = threading.Lock()
+
+
+def pubsub_multiplexer(client: Optional[redis.Redis] = None
+                       ) -> PubSubMultiplexer:
+    """Returns the process wide pub/sub multiplexer of `client`'s node."""
+    client = client or main.redis_server
+    with _pubsub_multiplexer_lock:
+        if id(client) not in _pubsub_multiplexers:
+            _pubsub_multiplexers[id(client)] = PubSubMultiplexer(client)
+        return _pubsub_multiplexers[id(client)]
+
+
+class PubSubProducer(Producer):
+    """Produces output from a redis pub/sub channel.
+
+  Delivery is at-most-once. Subscriptions go through the process wide
+  `pubsub_multiplexer()` of the channel's node unless a multiplexer is
+  given.
+  """
+
+    def __init__(self,
+                 multiplexer: Optional[PubSubMultiplexer] = None,
+                 maxsize: int = DEFAULT_MAXSIZE,
+                 policy: str = DROP_OLDEST,
+                 router: Optional[ShardRouter] = None):
+        self.multiplexer = multiplexer
+        self.router = None if multiplexer else main.default_router(
+            None, router)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.channel: Optional[str] = None
+        self.subscription: Optional[Subscription] = None
+
+    def setup(self, consumer_id: t_consumer_id, **kwargs) -> None:
+        """Subscribe to the channel of `consumer_id`."""
+        if self.multiplexer is None:
+            client = None
+            if self.router is not None:
+                client = self.router.client_for(consumer_id)
+            self.multiplexer = pubsub_multiplexer(client)
+        self.channel = consumer_id
+        self.subscription = self.multiplexer.subscribe(consumer_id,
+                                                       self.maxsize,
+                                                       self.policy)
+
+    def get(self,
+            timeout: Optional[float] = None,
+            **optional_attrs) -> Iterator[Message]:
+        """Yields messages until closed, or until `timeout` passes idle."""
+        if self.subscription is None:
+            raise RuntimeError("Producer.setup() must be called first.")
+        while True:
+            message = self.subscription.get(timeout)
+            if message is None:
+                return
+            yield message
+
+    def close(self) -> None:
+        """Unsubscribe from the channel."""
+        if self.subscription is not None:
+            self.multiplexer.unsubscribe(self.subscription)
+            self.subscription = None
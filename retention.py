@@ -0,0 +1,252 @@
+"""Retention policies bounding the size of channel streams.
+
+A consumer records the policy of its channel in the channel's metadata hash
+at `setup()` time. Policies that XADD can express (`MaxLen`, `MaxAge`) are
+enforced inline on every append; all of them can also be enforced by a
+`RetentionTrimmer` running in the background of any process.
+"""
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import redis
+
+import main
+import streams
+from sharding import ShardRouter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRIM_INTERVAL = 60.0
+
+
+class RetentionPolicy:
+    """Decides which entries of a channel may be removed."""
+    name = ""
+
+    def spec(self) -> str:
+        """Returns the policy as recorded in the channel metadata."""
+        raise NotImplementedError
+
+    def xadd_kwargs(self) -> dict:
+        """Returns XADD arguments enforcing the policy inline, if any."""
+        return {}
+
+    def trim(self, client: redis.Redis, channel: str) -> int:
+        """Trims `channel` and returns the number of entries removed."""
+        raise NotImplementedError
+
+
+class MaxLen(RetentionPolicy):
+    """Keeps the latest `maxlen` entries.
+
+  With `approximate` the stream is trimmed with `~`, which only removes
+  whole macro nodes and is much cheaper than an exact trim.
+  """
+    name = "maxlen"
+
+    def __init__(self, maxlen: int, approximate: bool = True):
+        self.maxlen = maxlen
+        self.approximate = approximate
+
+    def spec(self) -> str:
+        return f"{self.name}:{self.maxlen}:{int(self.approximate)}"
+
+    def xadd_kwargs(self) -> dict:
+        return {"maxlen": self.maxlen, "approximate": self.approximate}
+
+    def trim(self, client: redis.Redis, channel: str) -> int:
+        return client.xtrim(channel,
+                            maxlen=self.maxlen,
+                            approximate=self.approximate)
+
+
+class MaxAge(RetentionPolicy):
+    """Keeps entries younger than `max_age_ms`, judged by their stream id."""
+    name = "maxage"
+
+    def __init__(self, max_age_ms: int, approximate: bool = True):
+        self.max_age_ms = max_age_ms
+        self.approximate = approximate
+
+    def spec(self) -> str:
+        return f"{self.name}:{self.max_age_ms}:{int(self.approximate)}"
+
+    def min_id(self) -> str:
+        return f"{max(int(time.time() * 1000) - self.max_age_ms, 0)}-0"
+
+    def xadd_kwargs(self) -> dict:
+        return {"minid": self.min_id(), "approximate": self.approximate}
+
+    def trim(self, client: redis.Redis, channel: str) -> int:
+        return client.xtrim(channel,
+                            minid=self.min_id(),
+                            approximate=self.approximate)
+
+
+class SlowestGroup(RetentionPolicy):
+    """Keeps every entry some consumer group may still need.
+
+  Entries older than both the last delivered id and the oldest pending
+  entry of every group are removed. Channels without consumer groups are
+  left alone. Only enforced by the background trimmer.
+  """
+    name = "slowest-group"
+
+    def __init__(self, approximate: bool = True):
+        self.approximate = approximate
+
+    def spec(self) -> str:
+        return f"{self.name}:{int(self.approximate)}"
+
+    def trim(self, client: redis.Redis, channel: str) -> int:
+        groups = client.xinfo_groups(channel)
+        if not groups:
+            return 0
+        pipe = client.pipeline(transaction=False)
+        for group in groups:
+            pipe.xpending(channel, group["name"])
+        ids: List[bytes] = [group["last-delivered-id"] for group in groups]
+        ids.extend(pending["min"] for pending in pipe.execute()
+                   if pending["pending"])
+        min_id = min(ids, key=_id_key)
+        return client.xtrim(channel,
+                            minid=min_id,
+                            approximate=self.approximate)
+
+
+def parse(spec) -> RetentionPolicy:
+    """Returns the policy recorded as `spec`."""
+    if isinstance(spec, bytes):
+        spec = spec.decode()
+    name, *args = spec.split(":")
+    if name == MaxLen.name:
+        return MaxLen(int(args[0]), bool(int(args[1])))
+    if name == MaxAge.name:
+        return MaxAge(int(args[0]), bool(int(args[1])))
+    if name == SlowestGroup.name:
+        return SlowestGroup(bool(int(args[0])))
+    raise ValueError(f"Unknown retention policy: {spec!r}")
+
+
+def record(client: redis.Redis, channel: str,
+           policy: RetentionPolicy) -> None:
+    """Records `policy` as the retention policy of `channel`."""
+    client.hset(streams.meta_key(channel), "retention", policy.spec())
+
+
+async def arecord(client, channel: str, policy: RetentionPolicy) -> None:
+    """asyncio counterpart of `record`."""
+    await client.hset(streams.meta_key(channel), "retention", policy.spec())
+
+
+class TrimStats:
+    """Totals of the trims of one channel."""
+
+    def __init__(self):
+        self.runs = 0
+        self.entries_removed = 0
+        self.bytes_reclaimed = 0
+
+    def __repr__(self) -> str:
+        return (f"TrimStats(runs={self.runs}, "
+                f"entries_removed={self.entries_removed}, "
+                f"bytes_reclaimed={self.bytes_reclaimed})")
+
+
+class RetentionTrimmer:
+    """Periodically enforces the recorded retention policy of every channel.
+
+  Channels are discovered by scanning the metadata hashes of every node of
+  the router, or of `client` without one, so a trimmer can run in any
+  process; channels whose stream is gone are skipped. Reclaimed
+  bytes are measured with `MEMORY USAGE … SAMPLES 0`, which walks the whole
+  stream, before and after each trim that removed entries.
+  """
+
+    def __init__(self,
+                 client: Optional[redis.Redis] = None,
+                 interval: float = DEFAULT_TRIM_INTERVAL,
+                 router: Optional[ShardRouter] = None):
+        self.client = client or main.redis_server
+        self.router = main.default_router(client, router)
+        self.interval = interval
+        self.stats: Dict[str, TrimStats] = {}
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def bytes_reclaimed(self) -> int:
+        return sum(stats.bytes_reclaimed for stats in self.stats.values())
+
+    @property
+    def entries_removed(self) -> int:
+        return sum(stats.entries_removed for stats in self.stats.values())
+
+    def run_once(self) -> int:
+        """Trims every channel once and returns the entries removed."""
+        removed = 0
+        nodes = (self.router.clients.values()
+                 if self.router is not None else [self.client])
+        for client in nodes:
+            for key in client.scan_iter(match=f"{streams.META_PREFIX}*"):
+                spec = client.hget(key, "retention")
+                if spec is None:
+                    continue
+                channel = streams.channel_name(key)[len(streams.META_PREFIX):]
+                removed += self.trim(channel, parse(spec), client)
+        return removed
+
+    def trim(self,
+             channel: str,
+             policy: RetentionPolicy,
+             client: Optional[redis.Redis] = None) -> int:
+        """Trims `channel` with `policy` and records the outcome.
+
+    The channel is trimmed on `client`, by default on the node it is routed
+    to.
+    """
+        if client is None:
+            client = (self.router.client_for(channel)
+                      if self.router is not None else self.client)
+        before = client.memory_usage(channel, samples=0)
+        if before is None:
+            return 0
+        removed = policy.trim(client, channel)
+        stats = self.stats.setdefault(channel, TrimStats())
+        stats.runs += 1
+        if removed:
+            after = client.memory_usage(channel, samples=0) or 0
+            stats.entries_removed += removed
+            stats.bytes_reclaimed += max(before - after, 0)
+        return removed
+
+    def start(self) -> None:
+        """Runs `run_once` every `interval` seconds in a daemon thread."""
+        if self._thread is None:
+            self._closed.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="retention-trimmer",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._closed.wait(self.interval):
+            try:
+                self.run_once()
+            except redis.RedisError:
+                logger.exception("Retention trim failed.")
+
+
+def _id_key(stream_id) -> tuple:
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode()
+    ms, _, seq = stream_id.partition("-")
+    return int(ms), int(seq or 0)
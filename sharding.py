@@ -0,0 +1,204 @@
+"""Shards channels across several redis nodes by consistent hashing.
+
+Each channel lives on exactly one node: its stream, consumer groups and
+metadata hash move together. When nodes are added, only the channels whose
+ring position now falls on another node have to be migrated with
+`rebalance`.
+"""
+import bisect
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import redis
+import redis.asyncio
+
+import streams
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLICAS = 160
+DEFAULT_MIGRATE_BATCH = 1000
+_MAX_SEQ = 2**64 - 1
+# Consumer group used to create an empty stream on the target node.
+_MIGRATE_GROUP = "rmq:migrate"
+
+
+class HashRing:
+    """Consistent hash ring placing `replicas` virtual points per node."""
+
+    def __init__(self, nodes: Iterable[str] = (),
+                 replicas: int = DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(set(self._owners.values()))
+
+    def add(self, node: str) -> None:
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node: str) -> None:
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def node_for(self, key: str) -> str:
+        """Returns the node owning `key`."""
+        if not self._points:
+            raise LookupError("The hash ring has no nodes.")
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class ShardRouter:
+    """Routes channels to redis nodes, given as URLs, with a pool per node."""
+
+    def __init__(self,
+                 urls: Iterable[str],
+                 replicas: int = DEFAULT_REPLICAS,
+                 max_connections: Optional[int] = None):
+        self.urls = list(urls)
+        self.max_connections = max_connections
+        self.ring = HashRing(self.urls, replicas)
+        self.clients: Dict[str, redis.Redis] = {
+            url: redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+                url, max_connections=max_connections))
+            for url in self.urls
+        }
+        self._async_clients: Dict[str, redis.asyncio.Redis] = {}
+
+    def node_for(self, channel: str) -> str:
+        """Returns the URL of the node owning `channel`."""
+        return self.ring.node_for(channel)
+
+    def client_for(self, channel: str) -> redis.Redis:
+        """Returns the client of the node owning `channel`."""
+        return self.clients[self.node_for(channel)]
+
+    def async_client_for(self, channel: str) -> redis.asyncio.Redis:
+        """Returns an asyncio client of the node owning `channel`.
+
+    asyncio clients share one bounded pool per node, created on first use.
+    """
+        url = self.node_for(channel)
+        if url not in self._async_clients:
+            pool = redis.asyncio.BlockingConnectionPool.from_url(
+                url, max_connections=self.max_connections or 64, timeout=None)
+            self._async_clients[url] = redis.asyncio.Redis(
+                connection_pool=pool)
+        return self._async_clients[url]
+
+    def channels(self) -> Iterable[str]:
+        """Yields every channel set up on any node."""
+        for client in self.clients.values():
+            for key in client.scan_iter(match=f"{streams.META_PREFIX}*"):
+                yield streams.channel_name(key)[len(streams.META_PREFIX):]
+
+
+def rebalance(old: ShardRouter,
+              new: ShardRouter,
+              dry_run: bool = False,
+              batch: int = DEFAULT_MIGRATE_BATCH) -> List[str]:
+    """Migrates every channel whose node differs between `old` and `new`.
+
+  Returns the migrated channels. Writers of a channel should be paused while
+  it is migrated: entries added to the old node after its stream was copied
+  are lost.
+  """
+    moved = []
+    for channel in list(old.channels()):
+        source, target = old.node_for(channel), new.node_for(channel)
+        if source == target:
+            continue
+        moved.append(channel)
+        if dry_run:
+            continue
+        logger.info("Migrating %s from %s to %s.", channel, source, target)
+        migrate(old.clients[source], new.clients[target], channel, batch)
+    return moved
+
+
+def migrate(source: redis.Redis,
+            target: redis.Redis,
+            channel: str,
+            batch: int = DEFAULT_MIGRATE_BATCH) -> int:
+    """Moves the stream, consumer groups and metadata of `channel`.
+
+  Entries keep their ids and the metadata keeps its expiry, if any. Each
+  consumer group resumes after its last delivered id, or just before its
+  oldest pending entry so that entries not yet acknowledged are delivered
+  again. Returns the entries copied.
+  """
+    if target.exists(channel):
+        raise RuntimeError(f"{channel} already exists on the target node.")
+    copied = 0
+    if source.exists(channel):
+        copied = _copy_stream(source, target, channel, batch)
+    meta = source.hgetall(streams.meta_key(channel))
+    if meta:
+        target.hset(streams.meta_key(channel), mapping=meta)
+        ttl = source.pttl(streams.meta_key(channel))
+        if ttl > 0:
+            target.pexpire(streams.meta_key(channel), ttl)
+    source.delete(channel, streams.meta_key(channel))
+    return copied
+
+
+def _copy_stream(source: redis.Redis, target: redis.Redis, channel: str,
+                 batch: int) -> int:
+    last_id = _text(source.xinfo_stream(channel)["last-generated-id"])
+    copied = 0
+    start = "-"
+    while True:
+        entries = source.xrange(channel, min=start, count=batch)
+        if not entries:
+            break
+        pipe = target.pipeline(transaction=False)
+        for message_id, fields in entries:
+            pipe.xadd(channel, fields, id=message_id)
+        pipe.execute()
+        copied += len(entries)
+        start = f"({_text(entries[-1][0])}"
+    # Keep the last generated id so that new entries, and groups that were
+    # past deleted entries, continue after it.
+    if not copied:
+        target.xgroup_create(channel, _MIGRATE_GROUP, id="0", mkstream=True)
+        target.xgroup_destroy(channel, _MIGRATE_GROUP)
+    if start != f"({last_id}" and last_id != "0-0":
+        target.execute_command("XSETID", channel, last_id)
+    for group in source.xinfo_groups(channel):
+        resume_id = group["last-delivered-id"]
+        pending = source.xpending(channel, group["name"])
+        if pending["pending"]:
+            resume_id = _before(pending["min"])
+        target.xgroup_create(channel,
+                             group["name"],
+                             id=resume_id,
+                             mkstream=True)
+    return copied
+
+
+def _before(stream_id) -> str:
+    ms, _, seq = _text(stream_id).partition("-")
+    if int(seq):
+        return f"{ms}-{int(seq) - 1}"
+    return f"{int(ms) - 1}-{_MAX_SEQ}"
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
@@ -0,0 +1,44 @@
+"""Helpers shared by the redis streams consumers and producers."""
+import os
+import socket
+import uuid
+
+import redis
+
+DEFAULT_GROUP = "rmq"
+META_PREFIX = "rmq:meta:"
+
+
+def new_channel() -> str:
+    """Returns a fresh, unique channel name."""
+    return f"rmq:{uuid.uuid4().hex}"
+
+
+def meta_key(channel: str) -> str:
+    """Returns the key of the metadata hash of `channel`."""
+    return f"{META_PREFIX}{channel}"
+
+
+def consumer_name() -> str:
+    """Returns a consumer name unique to this process."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def is_busygroup(exc: redis.ResponseError) -> bool:
+    """Whether `exc` reports that the consumer group already exists."""
+    return str(exc).startswith("BUSYGROUP")
+
+
+def is_nogroup(exc: redis.ResponseError) -> bool:
+    """Whether `exc` reports a missing stream or consumer group."""
+    return str(exc).startswith("NOGROUP")
+
+
+def channel_name(stream) -> str:
+    """Returns the stream name of a redis reply as `str`."""
+    return stream.decode() if isinstance(stream, bytes) else stream
+
+
+def text(value) -> str:
+    """Returns a redis reply, e.g. a stream id, as `str`."""
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark",
+                     action="store_true",
+                     help="Run the load tests marked `benchmark`.")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark") or os.environ.get("RMQ_BENCHMARK"):
+        return
+    skip = pytest.mark.skip(
+        reason="load test, run with --benchmark or RMQ_BENCHMARK=1")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
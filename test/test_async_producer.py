@@ -0,0 +1,197 @@
+import asyncio
+
+import fakeredis
+import pytest
+import redis
+
+from async_producer import (AsyncStreamMultiplexer, AsyncStreamProducer,
+                            stream_multiplexer)
+from consumer import StreamConsumer
+
+
+class BlockingClient:
+    """Sleeps on empty reads, as fakeredis ignores BLOCK."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def xreadgroup(self, *args, **kwargs):
+        response = await self._client.xreadgroup(*args, **kwargs)
+        if not response:
+            await asyncio.sleep(0.01)
+        return response
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def sync_client(server):
+    return fakeredis.FakeRedis(server=server)
+
+
+def _multiplexer(server, **kwargs):
+    return AsyncStreamMultiplexer(
+        BlockingClient(fakeredis.FakeAsyncRedis(server=server)), **kwargs)
+
+
+def test_get_acks_while_a_backlog_is_queued(server, sync_client):
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+    consumer.consume_many({"n": n} for n in range(10))
+
+    async def handle_slowly():
+        multiplexer = _multiplexer(server, count=3)
+        producer = AsyncStreamProducer(multiplexer)
+        await producer.setup(channel)
+        pending = []
+        received = 0
+        async for message in producer.get():
+            received += 1
+            pending.append(await producer.pending())
+            if received == 10:
+                break
+            await asyncio.sleep(0.005)
+        await producer.close()
+        await multiplexer.close()
+        return pending
+
+    pending = asyncio.run(handle_slowly())
+    # Acks waiting for the queue to drain would leave all 10 pending.
+    assert max(pending) < 10
+    assert sync_client.xpending(channel, "rmq")["pending"] == 1
+
+
+def test_channel_is_read_until_its_last_producer_closes(server, sync_client):
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+
+    async def read_after_first_close():
+        multiplexer = _multiplexer(server)
+        first = AsyncStreamProducer(multiplexer)
+        second = AsyncStreamProducer(multiplexer)
+        await first.setup(channel)
+        await second.setup(channel)
+        await first.close()
+        await first.close()
+        consumer.consume({"n": 0})
+        messages = second.get()
+        message = await asyncio.wait_for(messages.__anext__(), 1)
+        await messages.aclose()
+        await second.close()
+        registered = channel in multiplexer._queues
+        await multiplexer.close()
+        return message, registered
+
+    message, registered = asyncio.run(read_after_first_close())
+    assert message.data == {"n": 0}
+    assert not registered
+
+
+def _run_producer(server, channel, count, **kwargs):
+    """Returns the first `count` messages and the multiplexer read them."""
+
+    async def read():
+        multiplexer = kwargs.pop("multiplexer", None) or _multiplexer(
+            server, idle_interval=0.001)
+        producer = AsyncStreamProducer(multiplexer, **kwargs)
+        await producer.setup(channel)
+        messages = []
+        async for message in producer.get():
+            messages.append(message)
+            if len(messages) == count:
+                break
+        await producer.close()
+        await multiplexer.close()
+        return messages
+
+    return asyncio.run(asyncio.wait_for(read(), 5))
+
+
+def test_round_trip_acknowledges(server, sync_client):
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+    consumer.consume_many({"n": n} for n in range(3))
+
+    messages = _run_producer(server, channel, 3)
+    assert [message.data["n"] for message in messages] == [0, 1, 2]
+    # The last message was still being handled when the loop broke.
+    assert sync_client.xpending(channel, "rmq")["pending"] == 1
+
+
+def test_undecodable_entries_are_dead_lettered(server, sync_client):
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+    consumer.consume({"n": 0})
+    sync_client.xadd(channel, {"d": b"\xff"})
+    consumer.consume({"n": 1})
+    multiplexer = _multiplexer(server, dead_letter="dlq")
+
+    messages = _run_producer(server, channel, 2, multiplexer=multiplexer)
+    assert [message.data["n"] for message in messages] == [0, 1]
+    assert [fields for _, fields in sync_client.xrange("dlq")] == [{
+        b"d": b"\xff"
+    }]
+    assert sync_client.xpending(channel, "rmq")["pending"] == 1
+
+
+def test_failed_reads_are_retried(server, sync_client):
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+    consumer.consume({"n": 0})
+
+    class FlakyClient(BlockingClient):
+        failures = 2
+
+        async def xreadgroup(self, *args, **kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise redis.ConnectionError("connection reset")
+            return await super().xreadgroup(*args, **kwargs)
+
+    client = FlakyClient(fakeredis.FakeAsyncRedis(server=server))
+    multiplexer = AsyncStreamMultiplexer(client, idle_interval=0.001)
+
+    messages = _run_producer(server, channel, 1, multiplexer=multiplexer)
+    assert messages[0].data == {"n": 0}
+    assert client.failures == 0
+
+
+def test_channels_without_their_group_are_unregistered(server, sync_client):
+    channel = StreamConsumer(sync_client).setup()
+
+    async def read_deleted():
+        multiplexer = _multiplexer(server, idle_interval=0.001)
+        await multiplexer.register(channel)
+        sync_client.xgroup_destroy(channel, "rmq")
+        for _ in range(100):
+            if channel not in multiplexer._queues:
+                break
+            await asyncio.sleep(0.01)
+        registered = channel in multiplexer._queues
+        await multiplexer.close()
+        return registered
+
+    assert not asyncio.run(read_deleted())
+
+
+def test_producers_share_the_process_wide_multiplexer(server):
+    client = fakeredis.FakeAsyncRedis(server=server)
+    first = AsyncStreamProducer(client=client, router=None)
+    second = AsyncStreamProducer(client=client, router=None)
+
+    async def setup():
+        await first.setup("shared")
+        await second.setup("shared")
+        await first.close()
+        await second.close()
+        await first.multiplexer.close()
+
+    asyncio.run(setup())
+    assert first.multiplexer is second.multiplexer
+    assert first.multiplexer is stream_multiplexer(client)
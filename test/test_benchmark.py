@@ -0,0 +1,43 @@
+import json
+import os
+
+import pytest
+
+from benchmarks import harness, server
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def client():
+    if not server.available():
+        pytest.skip("redis-server is not installed")
+    with server.spawn() as client:
+        yield client
+
+
+@pytest.mark.parametrize("mode", harness.MODES)
+def test_delivery_paths(client, mode, tmp_path):
+    scenarios = harness.matrix(modes=[mode],
+                               payload_sizes=[128, 1024],
+                               batch_sizes=[1, 100],
+                               channels=[1, 4],
+                               consumers=[1, 2],
+                               messages=2000)
+    report = harness.run_all(client, scenarios)
+
+    output = os.environ.get("RMQ_BENCHMARK_OUTPUT",
+                            str(tmp_path / "benchmark.json"))
+    if "{mode}" in output:
+        output = output.format(mode=mode)
+    harness.write(report, output)
+    with open(output) as written:
+        assert json.load(written) == report
+    for result in report["results"]:
+        assert result["complete"], result
+        assert result["delivered"] == result["expected"]
+        assert result["dropped"] == 0
+        assert result["msgs_per_s"] > 0
+        assert result["p50_ms"] <= result["p99_ms"]
+        if mode == harness.STREAMS:
+            assert result["bytes_per_msg"] > 0
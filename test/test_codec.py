@@ -0,0 +1,63 @@
+import fakeredis
+import pytest
+
+import codec
+from consumer import StreamConsumer
+from producer import StreamProducer
+
+EVENT = {"id": 7, "name": "created", "tags": ["a", "b"], "payload": "x" * 64}
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.mark.parametrize("name", sorted(codec.CODECS))
+def test_round_trip(name):
+    instance = codec.get_codec(name)
+    assert instance.name == name
+    assert instance.decode(instance.encode(EVENT)) == EVENT
+    fields = codec.encode_fields(instance, EVENT)
+    assert codec.decode_fields(instance, fields) == EVENT
+
+
+def test_zstd_compresses_above_threshold_only():
+    zstd = codec.ZstdCodec(threshold=100)
+    small, large = {"p": "x"}, {"p": "x" * 1000}
+    assert zstd.encode(small)[:1] == b"\x00"
+    assert zstd.encode(large)[:1] == b"\x01"
+    assert len(zstd.encode(large)) < len(codec.JsonCodec().encode(large))
+    # Decoding only depends on the header, not on the threshold.
+    other = codec.ZstdCodec(threshold=10**6)
+    assert other.decode(zstd.encode(small)) == small
+    assert other.decode(zstd.encode(large)) == large
+
+
+def test_producer_set_up_first_does_not_pick_the_codec(client):
+    producer = StreamProducer(client, claim_interval=None)
+    producer.setup("ch")
+    consumer = StreamConsumer(client, codec="zstd+msgpack")
+    consumer.setup("ch")
+    consumer.consume(EVENT)
+
+    assert consumer.codec.name == "zstd+msgpack"
+    assert producer.fetch(block_ms=1)[0].data == EVENT
+    assert producer.codec.name == "zstd+msgpack"
+
+
+def test_conflicting_preference_raises(client):
+    StreamConsumer(client, codec="msgpack").setup("ch")
+    assert StreamConsumer(client).setup("ch") == "ch"
+    with pytest.raises(ValueError):
+        StreamConsumer(client, codec="json").setup("ch")
+
+
+def test_decode_fields_with_decoded_responses():
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer(),
+                                 decode_responses=True)
+    consumer = StreamConsumer(client)
+    consumer.setup("ch")
+    consumer.consume(EVENT)
+    (_, fields), = client.xrange("ch")
+    assert codec.decode_fields(consumer.codec, fields) == EVENT
@@ -0,0 +1,70 @@
+import time
+
+import fakeredis
+import pytest
+
+import streams
+from consumer import PubSubConsumer, StreamConsumer
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+def test_pubsub_metadata_expires(client):
+    consumer = PubSubConsumer(client, meta_ttl=60)
+    channel = consumer.setup()
+    assert 0 < client.ttl(streams.meta_key(channel)) <= 60
+
+    client.persist(streams.meta_key(channel))
+    consumer._meta_refresh_at = 0.0
+    consumer.consume({"n": 1})
+    assert 0 < client.ttl(streams.meta_key(channel)) <= 60
+
+
+def test_pubsub_metadata_can_be_kept(client):
+    channel = PubSubConsumer(client, meta_ttl=None).setup()
+    assert client.ttl(streams.meta_key(channel)) == -1
+
+
+def test_consume_many_flushes_full_batches(client):
+    consumer = StreamConsumer(client, max_batch=2, max_linger_ms=60000)
+    channel = consumer.setup()
+
+    def events():
+        yield {"n": 0}
+        yield {"n": 1}
+        assert client.xlen(channel) == 2
+        yield {"n": 2}
+
+    assert len(consumer.consume_many(events())) == 3
+    assert client.xlen(channel) == 3
+
+
+def test_consume_many_flushes_on_linger(client):
+    consumer = StreamConsumer(client, max_batch=100, max_linger_ms=10)
+    channel = consumer.setup()
+
+    def events():
+        yield {"n": 0}
+        time.sleep(0.2)
+        assert client.xlen(channel) == 1
+        yield {"n": 1}
+
+    assert len(consumer.consume_many(events())) == 2
+    assert client.xlen(channel) == 2
+
+
+def test_consume_many_returns_ids_in_order(client):
+    consumer = StreamConsumer(client, max_batch=3, max_linger_ms=1)
+    channel = consumer.setup()
+
+    def events():
+        for n in range(10):
+            if n % 4 == 0:
+                time.sleep(0.01)
+            yield {"n": n}
+
+    ids = consumer.consume_many(events())
+    assert ids == [message_id for message_id, _ in client.xrange(channel)]
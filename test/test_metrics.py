@@ -0,0 +1,66 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from async_producer import AsyncStreamMultiplexer
+from consumer import StreamConsumer
+from metrics import (BATCH_SIZE, PENDING, InMemorySink,
+                     PrometheusTextExporter)
+from producer import StreamProducer
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def test_render_uses_a_snapshot():
+    sink = InMemorySink()
+    sink.observe(BATCH_SIZE, 3, channel="ch")
+    sink.set_gauge(PENDING, 2, channel="ch", group="g")
+    histograms, gauges = sink.snapshot()
+    sink.observe(BATCH_SIZE, 3, channel="ch")
+
+    assert histograms[BATCH_SIZE][(("channel", "ch"), )].count == 1
+    assert gauges == {PENDING: {(("channel", "ch"), ("group", "g")): 2}}
+    text = PrometheusTextExporter(sink).render()
+    assert 'rmq_batch_size_count{channel="ch"} 2' in text
+    assert 'rmq_pending_entries{channel="ch",group="g"} 2' in text
+
+
+def test_pending_is_reported_without_the_sweep(server):
+    client = fakeredis.FakeRedis(server=server)
+    sink = InMemorySink()
+    consumer = StreamConsumer(client)
+    channel = consumer.setup()
+    consumer.consume_many({"n": n} for n in range(3))
+    producer = StreamProducer(client, claim_interval=None, metrics=sink)
+    producer.setup(channel)
+
+    producer.fetch(block_ms=1)
+    labels = (("channel", channel), ("group", producer.group))
+    assert sink.gauges[PENDING][labels] == 3
+
+
+def test_async_multiplexer_reports_pending(server):
+    sync_client = fakeredis.FakeRedis(server=server)
+    consumer = StreamConsumer(sync_client)
+    channel = consumer.setup()
+    consumer.consume({"n": 0})
+    sync_client.xgroup_create(channel, "rmq", id="0")
+    sync_client.xreadgroup("rmq", "c", {channel: ">"})
+    sink = InMemorySink()
+    multiplexer = AsyncStreamMultiplexer(
+        fakeredis.FakeAsyncRedis(server=server), metrics=sink)
+
+    async def report():
+        await multiplexer.report_pending(channel)
+        sync_client.xadd(channel, {"n": 1})
+        sync_client.xreadgroup("rmq", "c", {channel: ">"})
+        # Throttled: the second report within the interval is skipped.
+        await multiplexer.report_pending(channel)
+
+    asyncio.run(report())
+    labels = (("channel", channel), ("group", "rmq"))
+    assert sink.gauges[PENDING][labels] == 1
@@ -0,0 +1,138 @@
+import time
+
+import fakeredis
+import pytest
+
+from consumer import PubSubConsumer, StreamConsumer
+from interface import Message
+from producer import (DROP_NEWEST, DROP_OLDEST, PubSubMultiplexer,
+                      StreamProducer, Subscription)
+
+
+IDLE_MS = 5
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.fixture
+def channel(client):
+    consumer = StreamConsumer(client)
+    channel = consumer.setup()
+    consumer.consume_many({"n": n} for n in range(3))
+    return channel
+
+
+def _producer(client, channel, consumer):
+    producer = StreamProducer(client,
+                              consumer=consumer,
+                              claim_min_idle_ms=IDLE_MS,
+                              claim_interval=None)
+    producer.setup(channel)
+    return producer
+
+
+def test_reclaim_skips_own_entries(client, channel):
+    producer = _producer(client, channel, "c1")
+    assert [m.data["n"] for m in producer.fetch()] == [0, 1, 2]
+    time.sleep(IDLE_MS * 2 / 1000)
+
+    assert producer.reclaim() == 0
+    assert producer.fetch(block_ms=1) == []
+
+
+def test_reclaim_claims_entries_of_other_consumers(client, channel):
+    crashed = _producer(client, channel, "c1")
+    crashed.fetch(2)
+    producer = _producer(client, channel, "c2")
+    time.sleep(IDLE_MS * 2 / 1000)
+
+    assert producer.reclaim() == 2
+    assert [m.data["n"] for m in producer.fetch()] == [0, 1]
+    assert [m.data["n"] for m in producer.fetch()] == [2]
+    assert producer.reclaim() == 0
+
+
+def test_get_acks_each_batch(client, channel):
+    producer = _producer(client, channel, "c1")
+    messages = producer.get(count=2)
+    assert next(messages).data == {"n": 0}
+    assert next(messages).data == {"n": 1}
+    assert producer.pending() == 2
+    assert next(messages).data == {"n": 2}
+    assert producer.pending() == 1
+    # The last message was not asked past, so it stays pending.
+    messages.close()
+    assert producer.pending() == 1
+
+
+def test_released_entries_are_retried_then_dead_lettered(client, channel):
+    producer = StreamProducer(client,
+                              consumer="c1",
+                              claim_min_idle_ms=IDLE_MS,
+                              claim_interval=None,
+                              max_deliveries=2,
+                              dead_letter="dead")
+    producer.setup(channel)
+    first = producer.fetch(1)
+    producer.release(*(message.id for message in first))
+    time.sleep(IDLE_MS * 2 / 1000)
+
+    assert producer.reclaim() == 1
+    assert producer.fetch() == first
+    producer.release(*(message.id for message in first))
+    time.sleep(IDLE_MS * 2 / 1000)
+
+    assert producer.reclaim() == 0
+    assert producer.pending() == 0
+    assert client.xlen("dead") == 1
+
+
+def test_undecodable_entries_are_dead_lettered(client, channel):
+    client.xadd(channel, {"d": b"\xff"})
+    producer = StreamProducer(client,
+                              consumer="c2",
+                              claim_min_idle_ms=IDLE_MS,
+                              claim_interval=None,
+                              dead_letter="dead")
+    producer.setup(channel)
+    client.xreadgroup(producer.group, "c1", {channel: ">"})
+    time.sleep(IDLE_MS * 2 / 1000)
+
+    assert producer.reclaim() == 3
+    assert [m.data["n"] for m in producer.fetch()] == [0, 1, 2]
+    client.xadd(channel, {"d": b"{"})
+    assert producer.fetch(block_ms=1) == []
+    assert client.xlen("dead") == 2
+    # Only the three delivered messages are left pending.
+    assert producer.pending() == 3
+
+
+@pytest.mark.parametrize("policy, kept", [(DROP_OLDEST, [2, 3]),
+                                          (DROP_NEWEST, [0, 1])])
+def test_full_subscription_drops_by_policy(policy, kept):
+    subscription = Subscription("ch", maxsize=2, policy=policy)
+    for n in range(4):
+        subscription.put(Message("ch", None, n))
+
+    assert subscription.dropped == 2
+    assert [subscription.get(0).data, subscription.get(0).data] == kept
+    assert subscription.get(0) is None
+
+
+def test_pubsub_listener_survives_undecodable_messages(client):
+    consumer = PubSubConsumer(client)
+    channel = consumer.setup()
+    multiplexer = PubSubMultiplexer(client, poll_interval=0.01)
+    subscription = multiplexer.subscribe(channel)
+    try:
+        client.publish(channel, b"\xff")
+        consumer.consume({"n": 1})
+        message = subscription.get(timeout=2)
+    finally:
+        multiplexer.close()
+
+    assert message.data == {"n": 1}
+    assert subscription.dropped == 1
@@ -0,0 +1,46 @@
+import fakeredis
+import pytest
+
+import retention
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.mark.parametrize("policy", [
+    retention.MaxLen(1000),
+    retention.MaxLen(5, approximate=False),
+    retention.MaxAge(60000),
+    retention.MaxAge(10, approximate=False),
+    retention.SlowestGroup(),
+    retention.SlowestGroup(approximate=False),
+])
+def test_spec_round_trip(policy):
+    parsed = retention.parse(policy.spec().encode())
+    assert type(parsed) is type(policy)
+    assert vars(parsed) == vars(policy)
+
+
+def test_parse_rejects_unknown_policies():
+    with pytest.raises(ValueError):
+        retention.parse("forever:1")
+
+
+def test_slowest_group_keeps_what_groups_need(client):
+    ids = [client.xadd("ch", {"n": n}) for n in range(10)]
+    client.xgroup_create("ch", "fast", id=ids[7])
+    client.xgroup_create("ch", "slow", id=ids[2])
+    client.xreadgroup("slow", "c", {"ch": ">"}, count=3)
+    client.xack("ch", "slow", ids[4], ids[5])
+
+    # ids[3] is still pending on "slow", everything before it can go.
+    assert retention.SlowestGroup(approximate=False).trim(client, "ch") == 3
+    assert client.xrange("ch")[0][0] == ids[3]
+
+
+def test_slowest_group_without_groups_keeps_everything(client):
+    client.xadd("ch", {"n": 0})
+    assert retention.SlowestGroup().trim(client, "ch") == 0
+    assert client.xlen("ch") == 1
@@ -0,0 +1,110 @@
+import fakeredis
+import pytest
+
+import retention
+import streams
+from consumer import StreamConsumer
+from producer import StreamProducer
+from sharding import HashRing, ShardRouter, _before, migrate
+
+NODES = ["redis://a", "redis://b", "redis://c"]
+KEYS = [f"rmq:{n}" for n in range(2000)]
+
+
+@pytest.fixture
+def source():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.fixture
+def target():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+def test_ring_spreads_keys_over_nodes():
+    ring = HashRing(NODES)
+    owners = [ring.node_for(key) for key in KEYS]
+    assert ring.nodes == NODES
+    for node in NODES:
+        assert owners.count(node) > len(KEYS) / len(NODES) / 2
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = HashRing(NODES)
+    after = HashRing(NODES + ["redis://d"])
+    moved = [
+        key for key in KEYS if before.node_for(key) != after.node_for(key)
+    ]
+    assert moved
+    assert all(after.node_for(key) == "redis://d" for key in moved)
+    assert len(moved) < len(KEYS) / 2
+
+    after.remove("redis://d")
+    assert all(before.node_for(key) == after.node_for(key) for key in KEYS)
+
+
+def test_empty_ring_raises():
+    with pytest.raises(LookupError):
+        HashRing().node_for("rmq:0")
+
+
+@pytest.mark.parametrize("stream_id, expected", [
+    (b"1700000000000-5", "1700000000000-4"),
+    ("1700000000000-0", f"1699999999999-{2**64 - 1}"),
+])
+def test_before(stream_id, expected):
+    assert _before(stream_id) == expected
+
+
+def test_migrate_moves_stream_groups_and_metadata(source, target):
+    consumer = StreamConsumer(source, retention=retention.MaxLen(100))
+    channel = consumer.setup()
+    consumer.consume_many({"n": n} for n in range(5))
+    producer = StreamProducer(source, claim_interval=None)
+    producer.setup(channel)
+    producer.ack(*(message.id for message in producer.fetch(2)))
+    unacked = producer.fetch(1)
+    entries = source.xrange(channel)
+    last_id = source.xinfo_stream(channel)["last-generated-id"]
+
+    assert migrate(source, target, channel, batch=2) == 5
+    assert not source.exists(channel, streams.meta_key(channel))
+    assert target.xrange(channel) == entries
+    assert target.xinfo_stream(channel)["last-generated-id"] == last_id
+    assert target.hgetall(streams.meta_key(channel)) == {
+        b"codec": b"json",
+        b"retention": b"maxlen:100:1",
+    }
+
+    moved = StreamProducer(target, claim_interval=None)
+    moved.setup(channel)
+    # The unacknowledged entry is delivered again, then the unread ones.
+    delivered = moved.fetch(10)
+    assert delivered[0].id == unacked[0].id
+    assert [m.data["n"] for m in delivered] == [2, 3, 4]
+
+
+def test_migrate_refuses_to_overwrite(source, target):
+    source.xadd("ch", {"n": 1})
+    target.xadd("ch", {"n": 2})
+    with pytest.raises(RuntimeError):
+        migrate(source, target, "ch")
+
+
+def test_trimmer_scans_every_node(source, target, monkeypatch):
+    router = ShardRouter(["redis://a", "redis://b"])
+    router.clients = {"redis://a": source, "redis://b": target}
+    for client in (source, target):
+        monkeypatch.setattr(client, "memory_usage", lambda *a, **k: 1)
+    channels = []
+    for n in range(20):
+        consumer = StreamConsumer(router=router,
+                                  retention=retention.MaxLen(1, False),
+                                  inline_trim=False)
+        channels.append(consumer.setup(f"rmq:{n}"))
+        consumer.consume_many({"n": i} for i in range(3))
+    assert {router.node_for(channel) for channel in channels} == set(
+        router.clients)
+
+    trimmer = retention.RetentionTrimmer(router=router)
+    assert trimmer.run_once() == 2 * len(channels)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import redis
+
+from interface import Message
+from worker import Worker
+
+
+class StubProducer:
+    """Hands out `messages` and records what the worker does with them."""
+
+    def __init__(self, count: int):
+        self.channel = "ch"
+        self.messages = [Message("ch", n, {"n": n}) for n in range(count)]
+        self.claim_min_idle_ms = 60000
+        self.auto_ack = True
+        self.acked = []
+        self.released = []
+        self.requested = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def fetch(self, count, block_ms):
+        self.requested.append(count)
+        with self._lock:
+            batch, self.messages = self.messages[:count], self.messages[count:]
+        return batch
+
+    def ack(self, *ids):
+        self.acked.extend(ids)
+
+    def release(self, *ids):
+        self.released.extend(ids)
+
+    def touch(self, *ids):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _run(worker: Worker) -> threading.Thread:
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    return thread
+
+
+def test_acks_only_after_success():
+    producer = StubProducer(6)
+    handled = threading.Event()
+
+    def handler(message):
+        if message.data["n"] % 2:
+            raise ValueError(message)
+        if message.data["n"] == 4:
+            handled.set()
+
+    worker = Worker(producer, handler, concurrency=2, block_ms=1)
+    thread = _run(worker)
+    assert handled.wait(5)
+    worker.stop()
+    thread.join(5)
+
+    assert sorted(producer.acked) == [0, 2, 4]
+    assert sorted(producer.released) == [1, 3, 5]
+    assert worker.handled == 3
+    assert producer.closed
+
+
+def test_backpressure_limits_in_flight():
+    producer = StubProducer(20)
+    gate = threading.Event()
+    worker = Worker(producer,
+                    lambda message: gate.wait(5),
+                    concurrency=4,
+                    batch_size=3,
+                    max_in_flight=5,
+                    block_ms=1)
+    thread = _run(worker)
+    try:
+        deadline = time.monotonic() + 5
+        while worker.in_flight < 5 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        assert worker.in_flight == 5
+        assert producer.requested == [3, 2]
+        assert len(producer.messages) == 15
+    finally:
+        gate.set()
+        worker.stop()
+        thread.join(5)
+
+
+def test_stop_drains_in_flight():
+    producer = StubProducer(4)
+    started = threading.Event()
+    gate = threading.Event()
+
+    def handler(message):
+        started.set()
+        gate.wait(5)
+
+    worker = Worker(producer, handler, block_ms=1)
+    thread = _run(worker)
+    assert started.wait(5)
+    worker.stop()
+    thread.join(0.1)
+    assert thread.is_alive() and not producer.acked
+
+    gate.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert sorted(producer.acked) == [0, 1, 2, 3]
+    assert worker.in_flight == 0
+
+
+def test_fetch_errors_are_retried():
+    producer = StubProducer(2)
+    fetch = producer.fetch
+    failures = []
+
+    def flaky_fetch(count, block_ms):
+        if not failures:
+            failures.append(count)
+            raise redis.ConnectionError("connection reset")
+        return fetch(count, block_ms)
+
+    producer.fetch = flaky_fetch
+    handled = threading.Event()
+    worker = Worker(producer,
+                    lambda message: message.data["n"] and handled.set(),
+                    block_ms=1)
+    thread = _run(worker)
+    assert handled.wait(5)
+    worker.stop()
+    thread.join(5)
+
+    assert failures
+    assert sorted(producer.acked) == [0, 1]
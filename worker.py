@@ -0,0 +1,210 @@
+"""Parallel worker runtime consuming a channel through a consumer group.
+
+The worker fetches batches with `producer.StreamProducer.fetch`, hands them
+to a thread or process pool and acknowledges each message only after its
+handler returned. Fetching pauses while `max_in_flight` messages are being
+handled, so a slow handler backs up into the stream instead of into memory.
+The idle time of in-flight messages is reset with `StreamProducer.touch`
+every half `claim_min_idle_ms`, so that other workers do not claim messages
+still waiting in the pool. Messages whose handler raised are released and
+redelivered by the reclaim sweep of the producer, up to its
+`max_deliveries`. Redis errors while fetching or acknowledging are logged
+and retried with exponential backoff.
+"""
+import concurrent.futures
+import importlib
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import redis
+
+from interface import Message
+from producer import StreamProducer
+
+logger = logging.getLogger(__name__)
+
+THREAD = "thread"
+PROCESS = "process"
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_IN_FLIGHT = 1000
+DEFAULT_BLOCK_MS = 1000
+IN_FLIGHT_BLOCK_MS = 10
+RETRY_INTERVAL = 0.1
+MAX_BACKOFF = 5.0
+
+t_handler = Callable[[Message], None]
+
+
+def load_handler(path: str) -> t_handler:
+    """Returns the handler named by `path`, as in `package.module:function`."""
+    module, _, name = path.partition(":")
+    if not name:
+        raise ValueError(f"Expected `module:function`, got {path!r}")
+    return getattr(importlib.import_module(module), name)
+
+
+def _handle_batch(handler: t_handler, messages: Sequence[Message]) -> list:
+    """Runs `handler` on each message and returns the ids it succeeded on."""
+    done = []
+    for message in messages:
+        try:
+            handler(message)
+        except Exception:
+            logger.exception("Handler failed on %s of %s.", message.id,
+                             message.channel)
+        else:
+            done.append(message.id)
+    return done
+
+
+def _ignore_sigint() -> None:
+    # Pool processes leave interrupts to the worker, which drains them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Worker:
+    """Dispatches the messages of one producer to a pool of handlers."""
+
+    def __init__(self,
+                 producer: StreamProducer,
+                 handler: t_handler,
+                 executor: str = THREAD,
+                 concurrency: Optional[int] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 block_ms: int = DEFAULT_BLOCK_MS):
+        if executor not in (THREAD, PROCESS):
+            raise ValueError(f"Unknown executor: {executor!r}")
+        self.producer = producer
+        self.producer.auto_ack = False
+        self.handler = handler
+        self.executor = executor
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.block_ms = block_ms
+        self.handled = 0
+        self._in_flight: Dict[concurrent.futures.Future, list] = {}
+        self._stopping = threading.Event()
+        self._touched = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        return sum(len(ids) for ids in self._in_flight.values())
+
+    def stop(self) -> None:
+        """Stops fetching; `run` returns once in-flight messages are done."""
+        self._stopping.set()
+
+    def run(self) -> None:
+        """Handles messages until `stop` is called, then drains."""
+        if self.executor == PROCESS:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.concurrency, initializer=_ignore_sigint)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency)
+        self._touched = time.monotonic()
+        failures = 0
+        with pool:
+            try:
+                while not self._stopping.is_set():
+                    try:
+                        self._step(pool)
+                    except redis.RedisError:
+                        failures += 1
+                        logger.exception("Redis failed while working on %s.",
+                                         self.producer.channel)
+                        self._stopping.wait(self._backoff(failures))
+                    else:
+                        failures = 0
+            finally:
+                while self._in_flight:
+                    self._complete(concurrent.futures.FIRST_COMPLETED,
+                                   self._touch_interval())
+                    self._touch()
+        self.producer.close()
+
+    def _step(self, pool: concurrent.futures.Executor) -> None:
+        room = self.max_in_flight - self.in_flight
+        if room <= 0:
+            self._complete(concurrent.futures.FIRST_COMPLETED,
+                           self._touch_interval())
+            self._touch()
+            return
+        # Block briefly while chunks are running so that their
+        # acknowledgements are not held back by an idle stream.
+        block_ms = (min(self.block_ms, IN_FLIGHT_BLOCK_MS)
+                    if self._in_flight else self.block_ms)
+        messages = self.producer.fetch(min(self.batch_size, room), block_ms)
+        self._dispatch(pool, messages)
+        self._complete(None)
+        self._touch()
+
+    def _dispatch(self, pool: concurrent.futures.Executor,
+                  messages: List[Message]) -> None:
+        if not messages:
+            return
+        size = -(-len(messages) // self.concurrency)
+        for start in range(0, len(messages), size):
+            chunk = messages[start:start + size]
+            future = pool.submit(_handle_batch, self.handler, chunk)
+            self._in_flight[future] = [message.id for message in chunk]
+
+    def _complete(self,
+                  return_when: Optional[str],
+                  timeout: Optional[float] = None) -> None:
+        """Acknowledges finished chunks, waiting as `return_when` says.
+
+    Messages of failed handlers are released to the reclaim sweep.
+    """
+        if not self._in_flight:
+            return
+        if return_when is None:
+            done = [future for future in self._in_flight if future.done()]
+        else:
+            done, _ = concurrent.futures.wait(self._in_flight,
+                                              timeout=timeout,
+                                              return_when=return_when)
+        succeeded, failed = [], []
+        for future in done:
+            ids = self._in_flight.pop(future)
+            try:
+                ok = set(future.result())
+            except Exception:
+                logger.exception("Handler batch failed.")
+                ok = set()
+            succeeded.extend(i for i in ids if i in ok)
+            failed.extend(i for i in ids if i not in ok)
+        if succeeded:
+            self.producer.ack(*succeeded)
+            self.handled += len(succeeded)
+        if failed:
+            self.producer.release(*failed)
+
+    def _backoff(self, failures: int) -> float:
+        return min(RETRY_INTERVAL * 2**(failures - 1), MAX_BACKOFF)
+
+    def _touch_interval(self) -> float:
+        return max(self.producer.claim_min_idle_ms / 2000.0,
+                   IN_FLIGHT_BLOCK_MS / 1000.0)
+
+    def _touch(self) -> None:
+        """Resets the idle time of in-flight messages when it is due."""
+        now = time.monotonic()
+        if (not self._in_flight or
+                now - self._touched < self._touch_interval()):
+            return
+        self._touched = now
+        self.producer.touch(*(message_id
+                              for ids in self._in_flight.values()
+                              for message_id in ids))
+
+    def install_signal_handlers(self) -> None:
+        """Stops gracefully on SIGINT and SIGTERM."""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stop())